@@ -0,0 +1,197 @@
+# Classifiers.py
+import time
+import pickle
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn.svm import SVC
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.kernel_approximation import Nystroem
+
+def default_models():
+    """The three models compared in this project, keyed by the name used for the saved files."""
+    return {
+        'svm': SVC(kernel='rbf', C=1.0, gamma='scale'),
+        'logreg': LogisticRegression(max_iter=1000),
+        'knn': KNeighborsClassifier(n_neighbors=5),
+    }
+
+def _fit(name, model, train_data, train_labels):
+    """Fits one model (in a joblib worker) and returns it with its fit time in seconds."""
+    start = time.perf_counter()
+    model.fit(train_data, train_labels)
+    return name, model, time.perf_counter() - start
+
+class Classifiers(object):
+    """
+    Trains the SVM, Logistic Regression and KNN models concurrently and
+    reports what each one costs to train, to run and to store.
+    """
+
+    def __init__(self, train_data, train_labels, models=None, n_jobs=-1):
+        models = models if models is not None else default_models()
+        print(f"[INFO] Training {len(models)} classifiers on {train_data.shape[0]} samples...")
+
+        # The models are independent, so each one trains in its own loky process
+        results = Parallel(n_jobs=n_jobs, backend='loky')(
+            delayed(_fit)(name, model, train_data, train_labels) for name, model in models.items()
+        )
+
+        self.models = {}
+        self.fit_times = {}
+        for name, model, fit_time in results:
+            self.models[name] = model
+            self.fit_times[name] = fit_time
+            print(f"[INFO] Trained {name} in {fit_time:.2f} s")
+
+    def report(self, test_data, test_labels=None, repeats=3):
+        """
+        Prints and returns, for each model: fit time, predict latency per
+        1,000 samples (best of `repeats` over test_data), pickled model size
+        and, if test_labels is given, accuracy.
+        """
+        stats = {}
+        for name, model in self.models.items():
+            best = float('inf')
+            for _ in range(repeats):
+                start = time.perf_counter()
+                predictions = model.predict(test_data)
+                best = min(best, time.perf_counter() - start)
+
+            stats[name] = {
+                'fit_s': self.fit_times[name],
+                'predict_ms_per_1000': best / max(len(test_data), 1) * 1000 * 1000,
+                'size_bytes': len(pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)),
+            }
+            if test_labels is not None:
+                stats[name]['accuracy'] = float(np.mean(predictions == test_labels))
+
+        print("\n--- CLASSIFIER REPORT ---")
+        print(f"{'model':<8}{'fit s':>10}{'ms/1k pred':>12}{'size KiB':>11}{'accuracy':>10}")
+        for name, s in stats.items():
+            accuracy = f"{s['accuracy']:.4f}" if 'accuracy' in s else '-'
+            print(f"{name:<8}{s['fit_s']:>10.2f}{s['predict_ms_per_1000']:>12.3f}{s['size_bytes'] / 1024:>11.1f}{accuracy:>10}")
+        print("--- END CLASSIFIER REPORT ---\n")
+        return stats
+
+class StreamingSVM(object):
+    """
+    Large-data stand-in for the kernel SVM: a Nystroem approximation of the
+    RBF kernel followed by a linear SVM (hinge loss) trained with SGD
+    partial_fit, one feature chunk at a time. Memory is bounded by one chunk
+    plus the landmark sample and a fixed-size reservoir sample of the
+    training data, which is kept to measure the gap against an exact SVC.
+    classes lists every label the stream can contain; if None it is taken
+    from the rows buffered to fit the kernel map.
+    """
+
+    def __init__(self, n_components=300, alpha=1e-4, landmark_samples=5000,
+                 reservoir_size=20000, classes=None, random_state=42):
+        self.n_components = n_components
+        self.alpha = alpha
+        self.landmark_samples = landmark_samples
+        self.reservoir_size = reservoir_size
+        self.classes = None if classes is None else np.asarray(classes)
+        self.random_state = random_state
+
+        self.feature_map = None
+        self.linear = SGDClassifier(loss='hinge', alpha=alpha, random_state=random_state)
+        self.samples_seen = 0
+        self.reservoir_X = None
+        self.reservoir_y = None
+        self._rng = np.random.default_rng(random_state)
+
+    def _fit_feature_map(self, X, y):
+        if self.classes is None:
+            self.classes = np.unique(y)
+            if self.classes.size < 2:
+                raise ValueError(f"The first {len(y)} samples hold only class {self.classes.tolist()}; "
+                                 "pass classes= to StreamingSVM")
+        # Same bandwidth as SVC(gamma='scale'), estimated on the landmark sample
+        variance = X.var()
+        gamma = 1.0 / (X.shape[1] * variance) if variance > 0 else 1.0
+        n_components = min(self.n_components, X.shape[0])
+        self.feature_map = Nystroem(kernel='rbf', gamma=gamma, n_components=n_components,
+                                    random_state=self.random_state).fit(X)
+
+    def _update_reservoir(self, X, y):
+        """Reservoir sampling (algorithm R), vectorised over a chunk."""
+        if self.reservoir_X is None:
+            self.reservoir_X = np.empty((0, X.shape[1]))
+            self.reservoir_y = np.empty(0, dtype=y.dtype)
+        free = self.reservoir_size - self.reservoir_X.shape[0]
+        if free > 0:
+            self.reservoir_X = np.concatenate([self.reservoir_X, X[:free]])
+            self.reservoir_y = np.concatenate([self.reservoir_y, y[:free]])
+        seen = self.samples_seen + np.arange(max(free, 0), X.shape[0])
+        slots = (self._rng.random(seen.size) * (seen + 1)).astype(np.int64)
+        replace = slots < self.reservoir_size
+        rows = np.arange(max(free, 0), X.shape[0])[replace]
+        self.reservoir_X[slots[replace]] = X[rows]
+        self.reservoir_y[slots[replace]] = y[rows]
+        self.samples_seen += X.shape[0]
+
+    def partial_fit(self, X, y, sample=True):
+        """One SGD step over a chunk; sample=False keeps it out of the reservoir (a repeated chunk)."""
+        if self.feature_map is None:
+            raise RuntimeError("Call fit() first, or _fit_feature_map() on a landmark sample.")
+        if sample:
+            self._update_reservoir(X, y)
+        self.linear.partial_fit(self.feature_map.transform(X), y, classes=self.classes)
+        return self
+
+    def fit(self, chunk_source, epochs=1):
+        """
+        chunk_source is a zero-argument callable returning an iterator of
+        (features, labels) chunks, e.g.
+        lambda: extractor.iter_feature_chunks(0, num_frames); it is called
+        once per epoch. The first chunks are buffered until landmark_samples
+        rows are available to fit the kernel map. Only the first epoch feeds
+        the reservoir, so later epochs do not sample the same rows twice.
+        """
+        for epoch in range(epochs):
+            sample = epoch == 0
+            pending = []
+            for X, y in chunk_source():
+                if self.feature_map is None:
+                    pending.append((X, y))
+                    if sum(len(p[1]) for p in pending) < self.landmark_samples:
+                        continue
+                    self._fit_feature_map(np.concatenate([p[0] for p in pending]), np.concatenate([p[1] for p in pending]))
+                    for pX, py in pending:
+                        self.partial_fit(pX, py, sample)
+                    pending = []
+                else:
+                    self.partial_fit(X, y, sample)
+
+            if pending:
+                # Fewer rows in total than landmark_samples
+                self._fit_feature_map(np.concatenate([p[0] for p in pending]), np.concatenate([p[1] for p in pending]))
+                for pX, py in pending:
+                    self.partial_fit(pX, py, sample)
+            print(f"[INFO] StreamingSVM epoch {epoch + 1}/{epochs}: {self.samples_seen} training samples.")
+        return self
+
+    def decision_function(self, X):
+        return self.linear.decision_function(self.feature_map.transform(X))
+
+    def predict(self, X):
+        return self.linear.predict(self.feature_map.transform(X))
+
+    def accuracy_gap(self, test_data, test_labels, max_samples=None):
+        """
+        Trains an exact SVC on (up to max_samples rows of) the reservoir sample
+        and returns the test accuracies of both models and their difference.
+        """
+        n = self.reservoir_X.shape[0] if max_samples is None else min(max_samples, self.reservoir_X.shape[0])
+        start = time.perf_counter()
+        exact = SVC(kernel='rbf', C=1.0, gamma='scale').fit(self.reservoir_X[:n], self.reservoir_y[:n])
+        exact_fit = time.perf_counter() - start
+
+        exact_accuracy = float(np.mean(exact.predict(test_data) == test_labels))
+        streaming_accuracy = float(np.mean(self.predict(test_data) == test_labels))
+        print(f"[INFO] Exact SVC on a {n}-sample subsample: accuracy {exact_accuracy:.4f} (fit {exact_fit:.2f} s)")
+        print(f"[INFO] StreamingSVM on {self.samples_seen} samples: accuracy {streaming_accuracy:.4f}")
+        print(f"[INFO] Accuracy gap (exact - streaming): {exact_accuracy - streaming_accuracy:+.4f}")
+        return {'exact': exact_accuracy, 'streaming': streaming_accuracy,
+                'gap': exact_accuracy - streaming_accuracy, 'subsample': n}
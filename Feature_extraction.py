@@ -1,71 +1,185 @@
 import cv2
 import os
+import tempfile
+import contextlib
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from weight_matrix import Weight_matrix
 from split import Spliter
 from getFeatureUV import getFeaturesUV
 from poscal import poscal
 from labeling import labeling
+from flow_store import ConcatFlowView, spill_flow
+from frame_source import ImageSource
+from frame_store import ConcatFrames
+from scaling import resize, scale_weight, scaled_size, to_native
 
 class Feature_extractor(object):
 
-    def __init__(self, originpics, forgpics, ab_forgpics, U, V, weigh):
+    def __init__(self, originpics, forgpics, ab_forgpics, U, V, weigh, cache=None, scale=1.0):
         self.originpics = originpics
         self.forgpics = forgpics
         self.ab_forgpics = ab_forgpics
         self.U = U
         self.V = V
         self.weigh = weigh
+        self.cache = cache
+        self.scale = scale
         self.m = U.shape[0]
 
+        # Flow frame i pairs frame i with its successor inside one dataset, so
+        # combined datasets need exactly one fg frame per flow frame, and the
+        # fg frames must split into datasets exactly where the flow does
+        if isinstance(U, ConcatFlowView):
+            if len(forgpics) != U.shape[2]:
+                raise ValueError(f"{len(forgpics)} frames do not line up with {U.shape[2]} flow frames")
+            if isinstance(forgpics, ConcatFrames) and not np.array_equal(U.offsets, forgpics.offsets):
+                raise ValueError(f"Frame datasets {forgpics.offsets.tolist()} do not line up with flow datasets {U.offsets.tolist()}")
+
+        # With scale < 1.0 masks and flow are resized once per frame and the
+        # blobs, splits, labels and features all work on the smaller frame;
+        # positions are returned in native coordinates.
+        self.scaled_weigh = scale_weight(weigh, scale)
+        self.size = scaled_size(U.shape[0], U.shape[1], scale)
+
+        # One Spliter for the whole run, and fg/ab masks decoded as single-channel
+        # uint8 with read-ahead, instead of an exists() + colour imread per frame.
+        # Datasets in a frame store are read straight from its memory map.
+        self.spliter = Spliter(scale=scale)
+        self.fg_source = forgpics if isinstance(forgpics, ConcatFrames) else ImageSource(forgpics)
+        self.ab_source = ImageSource(ab_forgpics)
+
+        # Perspective scaling is fixed, so its square root is computed once and
+        # the weighted flow is written into the same buffers for every frame.
+        self.sqrt_weigh = np.sqrt(self.scaled_weigh).reshape((self.size[0], 1))
+        buffer_dtype = np.result_type(U.dtype, self.sqrt_weigh.dtype)
+        self._u_weighted = np.empty(self.size, dtype=buffer_dtype)
+        self._v_weighted = np.empty(self.size, dtype=buffer_dtype)
+        self._workspace = {}
+
+    def close(self):
+        """Stops the mask read-ahead threads; frames read afterwards are decoded on demand."""
+        self.fg_source.close()
+        self.ab_source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
     def getPosition(self, img_mask, frame_index):
         """
         --- THIS IS THE FIX ---
         This function now accepts an image/mask directly, not a list of paths.
         --- END FIX ---
         """
-        this_Spliter = Spliter()
-        
-        # We find the path to the abnormal mask using the frame_index
-        ab_img_path = self.ab_forgpics[frame_index]
-        ab_img = cv2.imread(ab_img_path) if os.path.exists(ab_img_path) else None
+        # The abnormal mask for frame_index (None if it does not exist)
+        ab_img = resize(self.ab_source.get(frame_index), self.scale, cv2.INTER_NEAREST)
         
         # Get initial large blobs from the provided mask
-        initial_positions, mopho_img = poscal(img_mask)
+        initial_positions, mopho_img = poscal(resize(img_mask, self.scale, cv2.INTER_NEAREST), self.scale)
         
         # Use the Spliter to break up large blobs
-        final_positions = this_Spliter.split(initial_positions, mopho_img, self.weigh)
+        final_positions = self.spliter.split(initial_positions, mopho_img, self.scaled_weigh)
         
         # Label the final, clean set of positions
         _, label = labeling(final_positions, ab_img)
         
         return final_positions, label
 
-    def get_features_and_labels_with_indices(self, start, end):
-        # (This function is for training and remains unchanged)
-        all_features = []
-        all_labels = []
-        all_indices = []
-        frame_to_positions = {}
-
+    def get_features_and_labels_with_indices(self, start, end, workers=1):
+        """
+        Features, labels, (frame, box) indices and per-frame positions for the
+        flow frames in [start, end - 1). With workers > 1 the frame range is
+        split into chunks that run on a process pool; the flow is shared with
+        the workers through memory maps, and the results are merged in frame order.
+        """
         num_flow_frames = self.U.shape[2]
         limit = min(end - 1, num_flow_frames)
         total_frames_to_process = limit - start
         
         print(f"\n[INFO] Will process {total_frames_to_process} frames...")
 
-        for i in range(start, limit):
-            print(f"\r[INFO] Processing frame {i - start + 1}/{total_frames_to_process}...", end="", flush=True)
+        if workers > 1 and total_frames_to_process > 1:
+            with self._worker_pool(workers) as pool:
+                results = self._extract_parallel(start, limit, workers, pool)
+        else:
+            results = [self._extract_range(start, limit, verbose=True)]
+
+        all_features = []
+        all_labels = []
+        all_indices = []
+        frame_to_positions = {}
+        cache_hits = 0
+        for features, labels, indices, positions, hits in results:
+            all_features.extend(features)
+            all_labels.extend(labels)
+            all_indices.extend(indices)
+            frame_to_positions.update(positions)
+            cache_hits += hits
+        
+        print("\n[INFO] Feature extraction complete.")
+        if self.cache is not None:
+            print(f"[INFO] Feature cache: {cache_hits} frames reused, {total_frames_to_process - cache_hits} extracted.")
+        
+        if not all_features:
+            return np.array([]), np.array([]), [], {}
+
+        final_features = np.nan_to_num(np.concatenate(all_features, axis=0))
+        final_labels = np.nan_to_num(np.concatenate(all_labels, axis=0))
+
+        return final_features, final_labels, all_indices, frame_to_positions
+
+    def iter_feature_chunks(self, start, end, frames_per_chunk=500, workers=1):
+        """
+        Yields (features, labels) for consecutive blocks of frames_per_chunk
+        flow frames in [start, end - 1), so training code can stream over
+        millions of boxes without holding them all. Frames without boxes are
+        skipped; with a feature cache, later passes only read the cache.
+        With workers > 1 each block is extracted on one process pool that is
+        kept for the whole pass.
+        """
+        limit = min(end - 1, self.U.shape[2])
+        with self._worker_pool(workers) if workers > 1 else contextlib.nullcontext() as pool:
+            for chunk_start in range(start, limit, frames_per_chunk):
+                chunk_limit = min(chunk_start + frames_per_chunk, limit)
+                if pool is None:
+                    results = [self._extract_range(chunk_start, chunk_limit)]
+                else:
+                    results = self._extract_parallel(chunk_start, chunk_limit, workers, pool)
+                features = [f for result in results for f in result[0]]
+                labels = [l for result in results for l in result[1]]
+                if features:
+                    yield np.nan_to_num(np.concatenate(features, axis=0)), np.nan_to_num(np.concatenate(labels, axis=0))
+
+    def _extract_range(self, start, limit, verbose=False):
+        """
+        Per-frame feature and label arrays for frames [start, limit), in order,
+        plus the number of frames served from the feature cache.
+        """
+        all_features = []
+        all_labels = []
+        all_indices = []
+        frame_to_positions = {}
+        cache_hits = 0
 
-            # Use the original getPosition that works with file paths for training
-            positions, labels = self.getPosition_from_path(self.forgpics, i)
+        for i in range(start, limit):
+            if verbose:
+                print(f"\r[INFO] Processing frame {i - start + 1}/{limit - start}...", end="", flush=True)
 
-            if positions.size == 0:
-                continue
+            entry = None
+            if self.cache is not None:
+                key = self.cache.key(self.forgpics[i], self.ab_forgpics[i], self.U[:, :, i], self.V[:, :, i])
+                entry = self.cache.load(key)
 
-            u_weighted = self.U[:, :, i] * np.sqrt(self.weigh).reshape((self.m, 1))
-            v_weighted = self.V[:, :, i] * np.sqrt(self.weigh).reshape((self.m, 1))
-            features = getFeaturesUV(positions, u_weighted, v_weighted)
+            if entry is None:
+                features, labels, positions = self.frame_features(i)
+                if self.cache is not None:
+                    self.cache.store(key, features, labels, positions)
+            else:
+                features, labels, positions = entry
+                cache_hits += 1
 
             if features.size > 0:
                 all_features.append(features)
@@ -74,24 +188,85 @@ class Feature_extractor(object):
                     all_indices.append((i, local_idx))
                 
                 frame_to_positions[i] = positions
-        
-        print("\n[INFO] Feature extraction complete.")
-        
-        if not all_features:
-            return np.array([]), np.array([]), [], {}
 
-        final_features = np.nan_to_num(np.concatenate(all_features, axis=0))
-        final_labels = np.nan_to_num(np.concatenate(all_labels, axis=0))
+        return all_features, all_labels, all_indices, frame_to_positions, cache_hits
 
-        return final_features, final_labels, all_indices, frame_to_positions
+    def frame_features(self, i):
+        """Features, labels and positions of the boxes found in frame i (empty arrays if none)."""
+        # Use the original getPosition that works with file paths for training
+        positions, labels = self.getPosition_from_path(self.forgpics, i)
+
+        if positions.size == 0:
+            return np.zeros((0, 2)), np.zeros(0, dtype=int), np.zeros((0, 5))
+
+        u_weighted, v_weighted = self.weighted_flow(i)
+        features = getFeaturesUV(positions, u_weighted, v_weighted, workspace=self._workspace)
+        return features, labels, to_native(positions, self.scale)
+
+    @contextlib.contextmanager
+    def _worker_pool(self, workers):
+        """A process pool whose workers each hold a Feature_extractor over the shared flow."""
+        with tempfile.TemporaryDirectory(prefix='flow_share_') as share_dir:
+            U = shareable_flow(self.U, os.path.join(share_dir, 'u'))
+            V = shareable_flow(self.V, os.path.join(share_dir, 'v'))
+            init_args = (self.originpics, self.forgpics, self.ab_forgpics, U, V, self.weigh, self.cache, self.scale)
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=init_args) as pool:
+                yield pool
+
+    def _extract_parallel(self, start, limit, workers, pool):
+        """Runs _extract_range over chunks of [start, limit) on a _worker_pool."""
+        # A few chunks per worker keeps the pool busy when some frames are slower
+        chunk_size = max(1, -(-(limit - start) // (workers * 4)))
+        ranges = [(s, min(s + chunk_size, limit)) for s in range(start, limit, chunk_size)]
+
+        results = []
+        # map() yields in submission order, so the chunks come back in frame order
+        for done, result in enumerate(pool.map(_extract_worker, ranges), start=1):
+            print(f"\r[INFO] Finished chunk {done}/{len(ranges)} on {workers} workers...", end="", flush=True)
+            results.append(result)
+        return results
+
+    def weighted_flow(self, i):
+        """
+        Returns flow frame i scaled by sqrt(weight) per row, resized to the
+        processing scale (the vectors stay in native pixels per frame). The result
+        lives in buffers reused by the next call, so copy it if it must outlive the frame.
+        """
+        np.multiply(resize(self.U[:, :, i], self.scale), self.sqrt_weigh, out=self._u_weighted)
+        np.multiply(resize(self.V[:, :, i], self.scale), self.sqrt_weigh, out=self._v_weighted)
+        return self._u_weighted, self._v_weighted
 
     def getPosition_from_path(self, pics, index):
         """ The original getPosition function, renamed to be used by the training script. """
-        if not os.path.exists(pics[index]):
-            return np.zeros((0, 5)), None
-        
-        img = cv2.imread(pics[index])
+        if pics is self.forgpics:
+            img = self.fg_source.get(index)
+        else:
+            img = cv2.imread(pics[index], cv2.IMREAD_GRAYSCALE)
         if img is None:
             return np.zeros((0, 5)), None
         
-        return self.getPosition(img, index)
\ No newline at end of file
+        return self.getPosition(img, index)
+
+def shareable_flow(flow, path_prefix):
+    """
+    Returns flow in a form that pickles cheaply for worker processes: in-memory
+    arrays are spilled once to memory-mapped .npy files under path_prefix,
+    while store-backed arrays already pickle as their paths.
+    """
+    if isinstance(flow, ConcatFlowView):
+        return ConcatFlowView([shareable_flow(part, f'{path_prefix}_{k}') for k, part in enumerate(flow.parts)])
+    if isinstance(flow, np.ndarray):
+        return spill_flow(flow, path_prefix + '.npy')
+    return flow
+
+_worker_extractor = None
+
+def _init_worker(originpics, forgpics, ab_forgpics, U, V, weigh, cache, scale):
+    """Process-pool initializer: one Feature_extractor per worker process."""
+    global _worker_extractor
+    # Each process already owns a core, so keep OpenCV from spawning its own threads
+    cv2.setNumThreads(1)
+    _worker_extractor = Feature_extractor(originpics, forgpics, ab_forgpics, U, V, weigh, cache=cache, scale=scale)
+
+def _extract_worker(frame_range):
+    return _worker_extractor._extract_range(*frame_range)
@@ -0,0 +1,866 @@
+# benchmark.py
+import os
+import time
+import argparse
+import tempfile
+import tracemalloc
+import cv2
+import numpy as np
+
+from Feature_extraction import Feature_extractor
+from getFeatureUV import getFeaturesUV
+from poscal import poscal, KERNEL_SIZE, MORPH_ITERATIONS, MIN_AREA
+from poscalNormal import poscalNormal
+from model_store import export_model, load_model
+
+def synthetic_flow(height=240, width=320, frames=50, seed=0):
+    """Random float32 u/v stacks shaped like the loaded optical flow."""
+    rng = np.random.default_rng(seed)
+    U = rng.normal(size=(height, width, frames)).astype(np.float32)
+    V = rng.normal(size=(height, width, frames)).astype(np.float32)
+    return U, V
+
+def synthetic_boxes(height=240, width=320, count=40, seed=0):
+    """Random person-sized boxes in the [max_r, min_r, max_c, min_c, area] layout."""
+    rng = np.random.default_rng(seed)
+    min_r = rng.integers(0, height - 40, count)
+    min_c = rng.integers(0, width - 15, count)
+    max_r = min_r + rng.integers(10, 40, count)
+    max_c = min_c + rng.integers(4, 15, count)
+    return np.stack([max_r, min_r, max_c, min_c, (max_r - min_r) * (max_c - min_c)], axis=1).astype(float)
+
+def bench_allocations(num_frames=1000):
+    """
+    Bytes of per-frame temporaries (peak above the steady state) for the old
+    per-frame weighting against Feature_extractor.weighted_flow. Both feed the
+    same summed-area getFeaturesUV and must give bit-for-bit identical
+    features; against the original per-box roi.mean() they agree only to
+    rounding, so that comparison uses a tolerance.
+    """
+    U, V = synthetic_flow()
+    weight = np.linspace(0.5, 2.0, U.shape[0])
+    extractor = Feature_extractor([], [], [], U, V, weight)
+    boxes = synthetic_boxes()
+    m = U.shape[0]
+
+    def legacy(i):
+        u_weighted = U[:, :, i] * np.sqrt(weight).reshape((m, 1))
+        v_weighted = V[:, :, i] * np.sqrt(weight).reshape((m, 1))
+        return getFeaturesUV(boxes.copy(), u_weighted, v_weighted)
+
+    def current(i):
+        u_weighted, v_weighted = extractor.weighted_flow(i)
+        return getFeaturesUV(boxes.copy(), u_weighted, v_weighted, workspace=extractor._workspace)
+
+    def roi_mean(i):
+        u_weighted = U[:, :, i] * np.sqrt(weight).reshape((m, 1))
+        v_weighted = V[:, :, i] * np.sqrt(weight).reshape((m, 1))
+        data = np.zeros((boxes.shape[0], 2))
+        for k, (max_r, min_r, max_c, min_c, _) in enumerate(boxes.astype(int)):
+            data[k] = u_weighted[min_r:max_r, min_c:max_c].mean(), v_weighted[min_r:max_r, min_c:max_c].mean()
+        return data
+
+    deviation = 0.0
+    for i in range(U.shape[2]):
+        if not np.array_equal(legacy(i), current(i)):
+            raise AssertionError(f"Features differ on frame {i}")
+        deviation = max(deviation, np.abs(roi_mean(i) - current(i)).max())
+    if deviation > 1e-9:
+        raise AssertionError(f"Features deviate from roi.mean() by {deviation:.3g}")
+
+    print(f"[INFO] Features identical to the old weighting on all {U.shape[2]} distinct frames, "
+          f"within {deviation:.1e} of roi.mean().")
+    print(f"{'path':<10}{'temp KiB/frame':>16}{'total MiB':>12}{'ms/frame':>10}")
+    for name, fn in (('legacy', legacy), ('current', current)):
+        tracemalloc.start()
+        total = 0
+        start = time.perf_counter()
+        for k in range(num_frames):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            fn(k % U.shape[2])
+            total += tracemalloc.get_traced_memory()[1] - before
+        elapsed = time.perf_counter() - start
+        tracemalloc.stop()
+        print(f"{name:<10}{total / num_frames / 1024:>16.1f}{total / 2**20:>12.1f}{elapsed / num_frames * 1000:>10.3f}")
+
+def synthetic_masks(count=200, height=240, width=320, seed=0):
+    """Blob masks from thresholded smoothed noise, from a few large blobs to many small ones."""
+    rng = np.random.default_rng(seed)
+    masks = []
+    for k in range(count):
+        sigma = 1.5 + 6.0 * k / count
+        noise = cv2.GaussianBlur(rng.random((height, width)).astype(np.float32), (0, 0), sigma)
+        masks.append(((noise > np.quantile(noise, rng.uniform(0.5, 0.9))) * 255).astype(np.uint8))
+    return masks
+
+def gray_masks(count=50, height=240, width=320, seed=0):
+    """
+    Non-binary fg pictures like the ones poscal really gets (grayscale frames):
+    overlapping rectangles, textured or flat, of different grey levels, which
+    skimage's label() keeps apart.
+    """
+    rng = np.random.default_rng(seed)
+    masks = []
+    for k in range(count):
+        mask = np.zeros((height, width), dtype=np.uint8)
+        for _ in range(10):
+            r, c = rng.integers(0, height - 40), rng.integers(0, width - 40)
+            h, w = rng.integers(20, 40), rng.integers(20, 40)
+            mask[r:r + h, c:c + w] = rng.integers(80, 256, size=(h, w)) if k % 2 else rng.integers(1, 256)
+        masks.append(mask)
+    return masks
+
+def _poscal_reference(img):
+    """The skimage label/regionprops version of poscal, kept as the reference output."""
+    from skimage.measure import label, regionprops
+    if len(img.shape) > 2:
+        img = img[:, :, 0]
+    kernel = np.ones((KERNEL_SIZE, KERNEL_SIZE), np.uint8)
+    opened_img = cv2.morphologyEx(img, cv2.MORPH_OPEN, kernel, iterations=MORPH_ITERATIONS)
+    cleaned_img = cv2.morphologyEx(opened_img, cv2.MORPH_CLOSE, kernel, iterations=MORPH_ITERATIONS)
+    im_s_list = []
+    for prop in regionprops(label(cleaned_img)):
+        if prop.area < MIN_AREA:
+            continue
+        min_r, min_c, max_r, max_c = prop.bbox
+        im_s_list.append([max_r, min_r, max_c, min_c, prop.area])
+    if not im_s_list:
+        return np.zeros((0, 5)), cleaned_img
+    return np.array(im_s_list), cleaned_img
+
+def bench_poscal(count=200):
+    """Checks poscal against the regionprops reference on binary and grayscale masks and times both."""
+    masks = synthetic_masks(count) + gray_masks(count // 4)
+    # Masks shaped like the training inputs: 3-channel, with an empty frame
+    masks.append(np.zeros((240, 320, 3), dtype=np.uint8))
+    masks.append(cv2.cvtColor(masks[0], cv2.COLOR_GRAY2BGR))
+
+    blobs = 0
+    for k, mask in enumerate(masks):
+        expected, expected_img = _poscal_reference(mask)
+        actual, actual_img = poscal(mask)
+        if not (np.array_equal(expected, actual) and np.array_equal(expected_img, actual_img)):
+            raise AssertionError(f"poscal differs from the reference on mask {k}")
+        blobs += actual.shape[0]
+    print(f"[INFO] poscal matches the regionprops reference on {len(masks)} masks ({blobs} blobs).")
+
+    for name, fn in (('regionprops', _poscal_reference), ('poscal', poscal)):
+        start = time.perf_counter()
+        for mask in masks:
+            fn(mask)
+        print(f"{name:<12}{(time.perf_counter() - start) / len(masks) * 1000:>8.3f} ms/frame")
+
+def grid_mask(components, height=240, width=320):
+    """A 3-channel mask with the given number of separate person-like rectangles."""
+    cols = max(1, int(np.ceil(np.sqrt(components * width / height))))
+    rows = max(1, int(np.ceil(components / cols)))
+    cell_h, cell_w = height // rows, width // cols
+    mask = np.zeros((height, width, 3), dtype=np.uint8)
+    for k in range(components):
+        r, c = divmod(k, cols)
+        mask[r * cell_h + 1:(r + 1) * cell_h - 1, c * cell_w + 1:(c + 1) * cell_w - 1] = 255
+    return mask
+
+def _poscal_normal_reference(img1, img4):
+    """The per-component copy-and-search version of poscalNormal, kept as the reference output."""
+    from skimage import measure
+    img1 = img1[:, :, 0]
+    kernel = np.ones((6, 1), np.uint8)
+    im = cv2.morphologyEx(img1, cv2.MORPH_OPEN, kernel)
+    im = cv2.morphologyEx(im, cv2.MORPH_CLOSE, kernel)
+    im_labels = measure.label(im, connectivity=1)
+    num = im_labels.max()
+    if num == 0:
+        return np.zeros((1, 5)), im
+    im_s = np.zeros((num, 5))
+    for i in range(num):
+        temp = np.copy(im_labels)
+        temp[temp != (i + 1)] = 0
+        index = np.where(temp == (i + 1))
+        im_s[i, 0] = max(index[0])
+        im_s[i, 1] = min(index[0])
+        im_s[i, 2] = max(index[1])
+        im_s[i, 3] = min(index[1])
+        im_s[i, 4] = len(index[0])
+    return im_s, im
+
+def bench_poscal_normal(counts=(0, 10, 50, 100, 200, 400), repeats=5):
+    """poscalNormal against the reference at increasing numbers of components."""
+    masks = [grid_mask(n) for n in counts] + [m[:, :, None].repeat(3, axis=2) for m in synthetic_masks(20) + gray_masks(20)]
+    for k, mask in enumerate(masks):
+        expected, expected_im = _poscal_normal_reference(mask, None)
+        actual, actual_im = poscalNormal(mask, None)
+        if not (np.array_equal(expected, actual) and np.array_equal(expected_im, actual_im)):
+            raise AssertionError(f"poscalNormal differs from the reference on mask {k}")
+    print(f"[INFO] poscalNormal matches the reference on {len(masks)} masks.")
+
+    print(f"{'components':>10}{'reference ms':>14}{'current ms':>12}")
+    for n, mask in zip(counts, masks):
+        timings = []
+        for fn in (_poscal_normal_reference, poscalNormal):
+            start = time.perf_counter()
+            for _ in range(repeats):
+                fn(mask, None)
+            timings.append((time.perf_counter() - start) / repeats * 1000)
+        print(f"{n:>10}{timings[0]:>14.2f}{timings[1]:>12.2f}")
+
+def _compare_formats(model, queries, train_data=None, train_labels=None):
+    """
+    Saves model as a joblib pickle and as an exported array directory, then
+    prints size on disk, load time and predict latency per query batch for
+    both, and how often their predictions agree. train_data and train_labels
+    are the fitted data, which the KNN and SVC exports need.
+    """
+    import joblib
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pickle_path = os.path.join(tmp, 'model.pkl')
+        compact_path = os.path.join(tmp, 'model')
+        joblib.dump(model, pickle_path)
+        export_model(model, compact_path, train_data, train_labels)
+
+        sizes = {
+            'pickle': os.path.getsize(pickle_path),
+            'compact': sum(os.path.getsize(os.path.join(compact_path, f)) for f in os.listdir(compact_path)),
+        }
+        print(f"{'format':<10}{'size MiB':>10}{'load ms':>10}{'ms/frame':>10}")
+        predictions = {}
+        for name, path in (('pickle', pickle_path), ('compact', compact_path)):
+            start = time.perf_counter()
+            loaded = load_model(path)
+            load_ms = (time.perf_counter() - start) * 1000
+
+            start = time.perf_counter()
+            predictions[name] = np.concatenate([loaded.predict(q) for q in queries])
+            frame_ms = (time.perf_counter() - start) / len(queries) * 1000
+            print(f"{name:<10}{sizes[name] / 2**20:>10.2f}{load_ms:>10.2f}{frame_ms:>10.3f}")
+
+    agreement = np.mean(predictions['pickle'] == predictions['compact'])
+    print(f"[INFO] Predictions agree on {agreement * 100:.2f}% of {len(predictions['pickle'])} boxes.")
+
+def _synthetic_training_set(size, seed=0):
+    """2-D features with a ring-shaped decision boundary, like speed vs area outliers."""
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(size, 2))
+    y = (np.hypot(X[:, 0], X[:, 1]) > 1.2).astype(int)
+    return X, y
+
+def bench_knn(train_size=200000, boxes_per_frame=40, frames=200):
+    """Pickled KNeighborsClassifier against the compact memory-mapped export."""
+    from sklearn.neighbors import KNeighborsClassifier
+
+    from model_store import CompactKNN
+
+    X, y = _synthetic_training_set(train_size)
+    rng = np.random.default_rng(1)
+    queries = [rng.normal(size=(boxes_per_frame, 2)) for _ in range(frames)]
+    model = KNeighborsClassifier(n_neighbors=5).fit(X, y)
+    _compare_formats(model, queries, X, y)
+
+    # Neighbour distances must match, not just the votes; ties may pick other points at the
+    # same distance. The points are stored as float32, hence the tolerance.
+    for size in (train_size, 300):
+        reference = KNeighborsClassifier(n_neighbors=5).fit(X[:size], y[:size])
+        with tempfile.TemporaryDirectory() as tmp:
+            export_model(reference, tmp, X[:size], y[:size])
+            compact = load_model(tmp)
+            assert isinstance(compact, CompactKNN)
+            for q in queries:
+                expected, _ = reference.kneighbors(q)
+                dist, _ = compact.kneighbors(q)
+                if not np.allclose(dist, expected, rtol=0, atol=1e-6):
+                    raise AssertionError(f"CompactKNN neighbour distances differ from sklearn on {size} points")
+    print(f"[INFO] CompactKNN neighbour distances match sklearn on {len(queries)} query batches.")
+
+def bench_models(train_size=20000, boxes_per_frame=40, frames=200):
+    """Pickled SVC and LogisticRegression against their memory-mapped array exports."""
+    from sklearn.svm import SVC
+    from sklearn.linear_model import LogisticRegression
+
+    X, y = _synthetic_training_set(train_size)
+    rng = np.random.default_rng(1)
+    queries = [rng.normal(size=(boxes_per_frame, 2)) for _ in range(frames)]
+    for model in (SVC(kernel='rbf', C=1.0, gamma='scale'), LogisticRegression(max_iter=1000)):
+        print(f"\n[INFO] {type(model).__name__} on {train_size} samples")
+        _compare_formats(model.fit(X, y), queries, X, y)
+
+def _run_streams(models, features, frames):
+    """One thread per stream, each predicting `frames` feature batches; returns boxes per second."""
+    import threading
+
+    def worker(model):
+        for k in range(frames):
+            model.predict(features[k % len(features)])
+
+    threads = [threading.Thread(target=worker, args=(model,)) for model in models]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(models) * frames * features[0].shape[0] / (time.perf_counter() - start)
+
+def bench_service(kind='svm', stream_counts=(1, 8, 32), frames=100, boxes_per_frame=40,
+                  train_size=20000, max_latency=0.005):
+    """
+    Boxes per second for N streams calling predict once per frame on their
+    own, against the same streams batched through a PredictService in-process
+    and over its local socket. kind picks the model: the exported 'knn' or
+    'svm' as the detector loads them, or the pickled sklearn 'sklearn-svm'.
+    """
+    import secrets
+    import threading
+    from multiprocessing.connection import Listener
+    from sklearn.svm import SVC
+    from sklearn.neighbors import KNeighborsClassifier
+    from predict_service import PredictService, PredictClient, serve
+
+    X, y = _synthetic_training_set(train_size)
+    rng = np.random.default_rng(1)
+    features = [rng.normal(size=(boxes_per_frame, 2)) for _ in range(20)]
+
+    model = KNeighborsClassifier(n_neighbors=5) if kind == 'knn' else SVC(kernel='rbf', C=1.0, gamma='scale')
+    model.fit(X, y)
+    export_dir = tempfile.TemporaryDirectory()
+    if kind != 'sklearn-svm':
+        export_model(model, export_dir.name, X, y)
+        model = load_model(export_dir.name)
+
+    # One socket server for the whole run, on a free port, with a throwaway key
+    socket_service = PredictService(model, max_latency=max_latency)
+    authkey = secrets.token_bytes(32)
+    ready = threading.Event()
+    with Listener(('127.0.0.1', 0)) as probe:
+        address = probe.address
+    threading.Thread(target=serve, args=(socket_service, authkey, address), kwargs={'ready': ready}, daemon=True).start()
+    ready.wait()
+
+    print(f"{'streams':>8}{'per-frame box/s':>17}{'service box/s':>15}{'socket box/s':>14}{'rows/batch':>12}")
+    for n in stream_counts:
+        direct = _run_streams([model] * n, features, frames)
+
+        service = PredictService(model, max_latency=max_latency)
+        batched = _run_streams([service.stream(k) for k in range(n)], features, frames)
+        # A single stream bypasses the batching thread, so it runs no micro-batches
+        rows_per_batch = f"{service.rows / service.batches:.1f}" if service.batches else 'direct'
+        service.close()
+        try:
+            service.predict(features[0], 0)
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("A closed PredictService accepted a request")
+
+        clients = [PredictClient(k, address, authkey) for k in range(n)]
+        remote = _run_streams(clients, features, frames)
+        for client in clients:
+            client.close()
+        print(f"{n:>8}{direct:>17.0f}{batched:>15.0f}{remote:>14.0f}{rows_per_batch:>12}")
+    export_dir.cleanup()
+
+def synthetic_video(path, frames=300, height=240, width=320, people=12, seed=0):
+    """An MJPG video of bright person-sized rectangles walking over a black background with sparse noise."""
+    rng = np.random.default_rng(seed)
+    pos = rng.uniform([0, 0], [height - 40, width - 15], size=(people, 2))
+    vel = rng.uniform(-2, 2, size=(people, 2))
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 25, (width, height))
+    for _ in range(frames):
+        frame = ((rng.random((height, width)) < 0.01) * 120).astype(np.uint8)
+        for r, c in pos.astype(int):
+            frame[r:r + 36, c:c + 12] = 220
+        pos = np.clip(pos + vel, 0, [height - 40, width - 15])
+        writer.write(cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR))
+    writer.release()
+
+def bench_pipeline(frames=300, feature_workers=(1, 2, 4)):
+    """
+    StreamDetector.run (every step in one thread) against detector_pipeline
+    on a synthetic video: frames per second and a check that both give the
+    same verdicts for every frame.
+    """
+    from sklearn.linear_model import LogisticRegression
+    from main_detect import StreamDetector, open_source
+    from pipeline import detector_pipeline, frames_of
+
+    rng = np.random.default_rng(0)
+    model = LogisticRegression().fit(rng.normal(size=(200, 2)), rng.integers(0, 2, 200))
+    weight = np.linspace(0.5, 2.0, 240)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'video.avi')
+        synthetic_video(path, frames)
+
+        cap = open_source(path)
+        start = time.perf_counter()
+        expected = {index: verdicts for index, _, verdicts in StreamDetector(model, weight).run(cap)}
+        sequential = len(expected) / (time.perf_counter() - start)
+        cap.release()
+        boxes = sum(len(v) for v in expected.values())
+        print(f"[INFO] {len(expected)} frames, {boxes} boxes; sequential {sequential:.1f} fps")
+
+        print(f"{'feature workers':>16}{'fps':>8}{'speed-up':>10}")
+        for workers in feature_workers:
+            results = {}
+            cap = open_source(path)
+            pipeline = detector_pipeline(StreamDetector(model, weight), frames_of(cap),
+                                         lambda r: results.__setitem__(r[0], r[2]), feature_workers=workers)
+            start = time.perf_counter()
+            pipeline.run_sync()
+            fps = len(results) / (time.perf_counter() - start)
+            cap.release()
+            if results != expected:
+                raise AssertionError(f"Pipeline verdicts differ from StreamDetector.run with {workers} workers")
+            print(f"{workers:>16}{fps:>8.1f}{fps / sequential:>10.2f}")
+        pipeline.report()
+
+        # With drop_oldest frames may go missing after the flow stage, but every
+        # verdict that comes out must still be the one for that capture index
+        results = {}
+        cap = open_source(path)
+        pipeline = detector_pipeline(StreamDetector(model, weight), frames_of(cap),
+                                     lambda r: results.__setitem__(r[0], r[2]), maxsize=1, drop_oldest=True)
+        pipeline.run_sync()
+        cap.release()
+        if any(results[index] != expected[index] for index in results):
+            raise AssertionError("Pipeline verdicts with drop_oldest differ from StreamDetector.run")
+        print(f"[INFO] drop_oldest: {len(results)} of {len(expected)} frames classified, all matching.")
+
+def synthetic_scene(frames=200, height=240, width=320, people=12, abnormal=4, seed=0, textured=True):
+    """
+    Grayscale frames of textured person-sized rectangles over a black
+    background, and the matching abnormal masks: the first `abnormal`
+    people run (3-5 px/frame), the rest walk (0.3-1.5 px/frame). poscal
+    gives every grey level its own blob, so texture breaks most people into
+    specks; with textured=False each person is one flat grey level instead,
+    and so one blob.
+    """
+    rng = np.random.default_rng(seed)
+    size = np.array([36, 12])
+    pos = rng.uniform([0, 0], [height - size[0], width - size[1]], size=(people, 2))
+    speed = np.where(np.arange(people) < abnormal, rng.uniform(3, 5, people), rng.uniform(0.3, 1.5, people))
+    angle = rng.uniform(0, 2 * np.pi, people)
+    vel = np.stack([np.sin(angle), np.cos(angle)], axis=1) * speed[:, None]
+    textures = rng.integers(80, 255, size=(people, size[0], size[1]), dtype=np.uint8)
+    if not textured:
+        textures[:] = textures.mean(axis=(1, 2), keepdims=True).astype(np.uint8)
+
+    grays, masks = [], []
+    for _ in range(frames):
+        frame = np.zeros((height, width), dtype=np.uint8)
+        mask = np.zeros((height, width), dtype=np.uint8)
+        for k, (r, c) in enumerate(np.round(pos).astype(int)):
+            frame[r:r + size[0], c:c + size[1]] = textures[k]
+            if k < abnormal:
+                mask[r:r + size[0], c:c + size[1]] = 255
+        grays.append(frame)
+        masks.append(mask)
+        pos += vel
+        # Bounce off the borders
+        limit = np.array([height - size[0], width - size[1]])
+        out = (pos < 0) | (pos > limit)
+        vel[out] *= -1
+        pos = np.clip(pos, 0, limit)
+    return grays, masks
+
+def _load_dataset_frames(dataset_dir, max_frames):
+    """
+    Grayscale frames (from the frame store, else original_pics/*.tif) and
+    their ab_fg_pics/NNN.png masks (None where missing).
+    """
+    import glob
+    from generate_optical_flow import read_gray
+    from frame_store import open_frame_store
+    store = open_frame_store(dataset_dir)
+    if store is not None:
+        grays = [np.array(frame) for frame in store[:max_frames]]
+    else:
+        paths = sorted(glob.glob(os.path.join(dataset_dir, 'original_pics', '*.tif')))[:max_frames]
+        grays = [read_gray(p) for p in paths]
+    masks = [cv2.imread(os.path.join(dataset_dir, 'ab_fg_pics', f'{i + 1:03d}.png'), cv2.IMREAD_GRAYSCALE)
+             for i in range(len(grays))]
+    keep = [i for i, g in enumerate(grays) if g is not None]
+    return [grays[i] for i in keep], [masks[i] for i in keep]
+
+def bench_flow_engines(dataset_dir=None, frames=200, train_fraction=0.6):
+    """
+    For every flow engine: ms/frame of the flow itself, and the accuracy of an
+    SVM trained on the features of the first train_fraction of the frames and
+    tested on the rest, with boxes and labels made as in training (poscal,
+    Spliter, getFeaturesUV, labeling). Runs on a synthetic scene with known
+    runners, or on a dataset folder (original_pics + ab_fg_pics) if given.
+    """
+    from sklearn.svm import SVC
+    from flow_engines import ENGINES, make_engine
+    from main_detect import StreamDetector
+    from labeling import labeling
+    from weight_matrix import Weight_matrix
+
+    if dataset_dir is None:
+        grays, masks = synthetic_scene(frames)
+        weight = np.ones(grays[0].shape[0])
+        print(f"[INFO] Synthetic scene: {len(grays)} frames.")
+    else:
+        grays, masks = _load_dataset_frames(dataset_dir, frames)
+        weight = Weight_matrix(ref_data_path=os.path.dirname(os.path.abspath(dataset_dir)),
+                               frame_height=grays[0].shape[0]).get_weight_matrix()
+        print(f"[INFO] {dataset_dir}: {len(grays)} frames.")
+    split_at = int((len(grays) - 1) * train_fraction)
+
+    print(f"{'engine':<15}{'flow ms':>9}{'boxes':>8}{'abnormal':>10}{'accuracy':>10}")
+    for name in ENGINES:
+        engine = make_engine(name)
+        detector = StreamDetector(None, weight)
+        workspace = {}
+        flow_time = 0.0
+        per_frame = []
+        for i in range(len(grays) - 1):
+            start = time.perf_counter()
+            flow = engine.compute(grays[i], grays[i + 1])
+            flow_time += time.perf_counter() - start
+            positions, features = detector.frame_features(grays[i], flow, workspace)
+            _, labels = labeling(positions, masks[i])
+            per_frame.append((features, labels))
+
+        train = [f for f in per_frame[:split_at] if f[0].size > 0]
+        test = [f for f in per_frame[split_at:] if f[0].size > 0]
+        train_X, train_y = np.concatenate([f[0] for f in train]), np.concatenate([f[1] for f in train])
+        test_X, test_y = np.concatenate([f[0] for f in test]), np.concatenate([f[1] for f in test])
+        if np.unique(train_y).size < 2:
+            accuracy = float('nan')
+        else:
+            accuracy = np.mean(SVC(kernel='rbf', C=1.0, gamma='scale').fit(train_X, train_y).predict(test_X) == test_y)
+        total_y = np.concatenate([train_y, test_y])
+        print(f"{name:<15}{flow_time / (len(grays) - 1) * 1000:>9.2f}{total_y.size:>8}"
+              f"{total_y.mean():>10.3f}{accuracy:>10.4f}")
+
+def bench_warm_flow(dataset_dir=None, frames=200,
+                    configs=((1, 1, 10), (1, 2, 10), (2, 2, 10), (1, 2, 5), (1, 2, 25))):
+    """
+    Warm-started Farneback against the cold baseline: ms/frame and end-point
+    error (|flow - cold flow|, in pixels), mean over the poscal blobs of each
+    frame, where the features are measured, and over the whole frame.
+    Each config is (warm_levels, warm_iterations, refresh_every).
+    """
+    from flow_engines import FarnebackEngine, WarmFarnebackEngine
+
+    if dataset_dir is None:
+        grays, _ = synthetic_scene(frames)
+    else:
+        grays, _ = _load_dataset_frames(dataset_dir, frames)
+    pairs = len(grays) - 1
+    blobs = [poscal(g)[1] != 0 for g in grays[:-1]]
+
+    cold = FarnebackEngine()
+    start = time.perf_counter()
+    reference = [cold.compute(grays[i], grays[i + 1]) for i in range(pairs)]
+    cold_ms = (time.perf_counter() - start) / pairs * 1000
+
+    print(f"{'levels':>7}{'iters':>6}{'refresh':>8}{'ms/frame':>10}{'speed-up':>10}{'EPE blobs':>11}{'EPE all':>9}{'EPE max':>9}")
+    print(f"{'cold':>21}{cold_ms:>10.2f}{1.0:>10.2f}{0.0:>11.3f}{0.0:>9.3f}{0.0:>9.3f}")
+    for levels, iterations, refresh in configs:
+        engine = WarmFarnebackEngine(warm_levels=levels, warm_iterations=iterations, refresh_every=refresh)
+        start = time.perf_counter()
+        flows = [engine.compute(grays[i], grays[i + 1]) for i in range(pairs)]
+        warm_ms = (time.perf_counter() - start) / pairs * 1000
+
+        errors = [np.hypot(*(f - r).transpose(2, 0, 1)) for f, r in zip(flows, reference)]
+        in_blobs = np.concatenate([e[b] for e, b in zip(errors, blobs)])
+        every = np.stack(errors)
+        print(f"{levels:>7}{iterations:>6}{refresh:>8}{warm_ms:>10.2f}{cold_ms / warm_ms:>10.2f}"
+              f"{in_blobs.mean() if in_blobs.size else 0.0:>11.3f}{every.mean():>9.3f}{every.max():>9.3f}")
+
+def bench_motion_gate(segments=((150, False), (100, True), (150, False), (50, True), (50, False))):
+    """
+    StreamDetector with and without a MotionGate on a clip alternating
+    static, sensor-noise-only spells with walking and running people: time
+    per frame, skip ratio, frames from each onset of activity to the first
+    processed frame, and boxes the ungated detector reported on frames the
+    gate skipped.
+    """
+    from sklearn.linear_model import LogisticRegression
+    from main_detect import StreamDetector
+    from motion_gate import MotionGate
+
+    rng = np.random.default_rng(0)
+    frames, onsets = [], []
+    for length, active in segments:
+        if active:
+            onsets.append(len(frames))
+            frames.extend(synthetic_scene(length, seed=len(frames))[0])
+        else:
+            frames.extend([np.clip(rng.normal(0, 2, (240, 320)), 0, 255).astype(np.uint8) for _ in range(length)])
+
+    model = LogisticRegression().fit(rng.normal(size=(200, 2)), rng.integers(0, 2, 200))
+    weight = np.ones(240)
+    runs = {}
+    for name, gate in (('ungated', None), ('gated', MotionGate())):
+        detector = StreamDetector(model, weight, gate=gate)
+        start = time.perf_counter()
+        results = [detector.process(frame, k / 25.0) for k, frame in enumerate(frames)]
+        elapsed = time.perf_counter() - start
+        runs[name] = ({r[0]: r[2] for r in results if r is not None}, elapsed, gate)
+
+    ungated, ungated_time, _ = runs['ungated']
+    gated, gated_time, gate = runs['gated']
+    for index, verdicts in gated.items():
+        if verdicts != ungated[index]:
+            raise AssertionError(f"Gated verdicts differ on frame {index}")
+    # Frame index i is the pair (i, i + 1), so activity starting at frame s first shows in pair s - 1
+    delays = [min(i for i in gated if i >= s - 1) - (s - 1) for s in onsets]
+    missed = sum(len(v) for i, v in ungated.items() if i not in gated)
+    total = sum(len(v) for v in ungated.values())
+
+    print(f"[INFO] {len(frames)} frames, activity starting at frames {onsets}.")
+    print(f"{'run':<10}{'ms/frame':>10}{'processed':>11}")
+    print(f"{'ungated':<10}{ungated_time / len(frames) * 1000:>10.2f}{len(ungated):>11}")
+    print(f"{'gated':<10}{gated_time / len(frames) * 1000:>10.2f}{len(gated):>11}")
+    print(f"[INFO] Skip ratio {gate.skip_ratio:.3f}; CPU per frame cut {ungated_time / gated_time:.2f}x.")
+    print(f"[INFO] Onset delays (frames): {delays}; boxes on skipped frames: {missed} of {total}.")
+
+def bench_roi_flow(people_counts=(2, 6, 12), frames=100, height=480, width=640):
+    """
+    Full-frame Farneback against RoiFlowEngine on scenes with few to many
+    people: flow ms/frame, share of tiles a TiledFlowStoreWriter keeps, store
+    size, and how far the box features move (mean and 99th percentile of
+    |feature difference|, against the mean |feature|).
+    """
+    from flow_engines import FarnebackEngine, RoiFlowEngine
+    from flow_store import FlowStoreWriter, TiledFlowStoreWriter
+    from main_detect import StreamDetector
+
+    weight = np.ones(height)
+    print(f"{'people':>7}{'dense ms':>10}{'roi ms':>8}{'speed-up':>10}{'tiles':>8}{'dense MiB':>11}{'tiled MiB':>11}"
+          f"{'mean err':>10}{'p99 err':>9}{'mean |f|':>10}")
+    for people in people_counts:
+        grays, _ = synthetic_scene(frames, height, width, people=people, abnormal=people // 3, textured=False)
+        detector = StreamDetector(None, weight)
+        dense_engine, roi_engine = FarnebackEngine(), RoiFlowEngine(FarnebackEngine())
+        timings = {'dense': 0.0, 'roi': 0.0}
+        errors, magnitudes = [], []
+
+        with tempfile.TemporaryDirectory() as tmp:
+            with FlowStoreWriter(os.path.join(tmp, 'dense')) as dense_writer, \
+                    TiledFlowStoreWriter(os.path.join(tmp, 'tiled')) as tiled_writer:
+                for i in range(frames - 1):
+                    start = time.perf_counter()
+                    dense = dense_engine.compute(grays[i], grays[i + 1])
+                    timings['dense'] += time.perf_counter() - start
+                    start = time.perf_counter()
+                    roi = roi_engine.compute(grays[i], grays[i + 1])
+                    timings['roi'] += time.perf_counter() - start
+
+                    dense_writer.append(dense[..., 0], dense[..., 1])
+                    tiled_writer.append(roi[..., 0], roi[..., 1], roi_engine.last_regions)
+                    _, expected = detector.frame_features(grays[i], dense, {})
+                    _, actual = detector.frame_features(grays[i], roi, {})
+                    errors.append(np.abs(actual - expected).ravel())
+                    magnitudes.append(np.abs(expected).ravel())
+                total_tiles = tiled_writer.num_frames * -(-height // 16) * -(-width // 16)
+                kept = tiled_writer.stored_tiles / total_tiles
+            sizes = {name: sum(os.path.getsize(os.path.join(tmp, name, f)) for f in os.listdir(os.path.join(tmp, name)))
+                     for name in ('dense', 'tiled')}
+
+        errors, magnitudes = np.concatenate(errors), np.concatenate(magnitudes)
+        if errors.size:
+            feature_stats = f"{errors.mean():>10.4f}{np.percentile(errors, 99):>9.4f}{magnitudes.mean():>10.4f}"
+        else:
+            feature_stats = f"{'n/a':>10}{'n/a':>9}{'n/a':>10}"     # no boxes in any frame
+        print(f"{people:>7}{timings['dense'] / (frames - 1) * 1000:>10.2f}{timings['roi'] / (frames - 1) * 1000:>8.2f}"
+              f"{timings['dense'] / timings['roi']:>10.2f}{kept:>8.1%}{sizes['dense'] / 2**20:>11.1f}{sizes['tiled'] / 2**20:>11.1f}"
+              f"{feature_stats}")
+
+def bench_scale(scales=(1.0, 0.75, 0.5), frames=200, height=480, width=640, train_fraction=0.6):
+    """
+    StreamDetector at several processing scales on one synthetic scene: fps of
+    flow + features, boxes found, and the accuracy of an SVM trained on the
+    first train_fraction of the frames at that scale, plus the accuracy of the
+    full-resolution SVM applied unchanged to the scaled features.
+    """
+    from sklearn.svm import SVC
+    from main_detect import StreamDetector
+    from labeling import labeling
+    from scaling import resize
+
+    grays, masks = synthetic_scene(frames, height, width)
+    weight = np.ones(height)
+    split_at = int((len(grays) - 1) * train_fraction)
+    print(f"[INFO] Synthetic scene: {len(grays)} frames of {width}x{height}.")
+
+    reference = None
+    print(f"{'scale':>6}{'fps':>8}{'speed-up':>10}{'boxes':>8}{'accuracy':>10}{'1.0 model':>11}")
+    for scale in scales:
+        detector = StreamDetector(None, weight, scale=scale)
+        workspace = {}
+        per_frame = []
+        elapsed = 0.0
+        for i, gray in enumerate(grays):
+            start = time.perf_counter()
+            step = detector.flow_step(gray, i)
+            if step is not None:
+                frame_index, _, prev_gray, flow = step
+                positions, features = detector.frame_features(prev_gray, flow, workspace)
+            elapsed += time.perf_counter() - start
+            if step is not None:
+                _, labels = labeling(positions, resize(masks[frame_index], scale, cv2.INTER_NEAREST))
+                per_frame.append((features, labels))
+        fps = (len(grays) - 1) / elapsed
+
+        train = [f for f in per_frame[:split_at] if f[0].size > 0]
+        test = [f for f in per_frame[split_at:] if f[0].size > 0]
+        train_X, train_y = np.concatenate([f[0] for f in train]), np.concatenate([f[1] for f in train])
+        test_X, test_y = np.concatenate([f[0] for f in test]), np.concatenate([f[1] for f in test])
+        model = SVC(kernel='rbf', C=1.0, gamma='scale').fit(train_X, train_y)
+        accuracy = np.mean(model.predict(test_X) == test_y)
+        if reference is None:
+            reference = (model, fps)
+        transfer = np.mean(reference[0].predict(test_X) == test_y)
+        print(f"{scale:>6.2f}{fps:>8.1f}{fps / reference[1]:>10.2f}{train_y.size + test_y.size:>8}"
+              f"{accuracy:>10.4f}{transfer:>11.4f}")
+
+def _tree_size(path):
+    """(number of files, total bytes) under path."""
+    sizes = [os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names]
+    return len(sizes), sum(sizes)
+
+def bench_ingest(frames=1000, height=480, width=640):
+    """
+    The TIFF preparation (convert_to_tif, fg_pics, then one grayscale read of
+    every frame for the flow and one of every fg picture for training)
+    against ingesting the video once into a frame store and reading it twice:
+    wall time of each step, files written and disk usage, and a check that
+    both give the same grayscale frames.
+    """
+    import contextlib
+    from convert_to_tif import video_to_tiff_frames
+    from fg_pics import generate_fg_pics
+    from generate_optical_flow import read_gray
+    from frame_source import ImageSource
+    from frame_store import ingest_video, FrameStore
+
+    with tempfile.TemporaryDirectory() as tmp:
+        video = os.path.join(tmp, 'clip.avi')
+        synthetic_video(video, frames, height, width)
+        tiff_dir = os.path.join(tmp, 'tiff')
+        store_dir = os.path.join(tmp, 'store')
+        timings = {}
+
+        with open(os.devnull, 'w') as quiet, contextlib.redirect_stdout(quiet):
+            start = time.perf_counter()
+            video_to_tiff_frames(video, os.path.join(tiff_dir, 'original_pics'))
+            timings['tiff decode + write'] = time.perf_counter() - start
+            start = time.perf_counter()
+            generate_fg_pics(os.path.join(tiff_dir, 'original_pics'), os.path.join(tiff_dir, 'fg_pics'))
+            timings['tiff fg_pics'] = time.perf_counter() - start
+        # Numeric order: the zero-padded names stop sorting correctly past 999 frames
+        names = sorted(os.listdir(os.path.join(tiff_dir, 'original_pics')), key=lambda name: int(name.split('.')[0]))
+        paths = [os.path.join(tiff_dir, 'original_pics', name) for name in names]
+        start = time.perf_counter()
+        tiff_frames = [read_gray(p) for p in paths]
+        timings['tiff read for flow'] = time.perf_counter() - start
+        fg_paths = [p.replace('original_pics', 'fg_pics') for p in paths]
+        source = ImageSource(fg_paths)
+        start = time.perf_counter()
+        checksum = sum(int(source.get(i)[0, 0]) for i in range(len(fg_paths)))
+        timings['tiff read for training'] = time.perf_counter() - start
+        source.close()
+
+        with open(os.devnull, 'w') as quiet, contextlib.redirect_stdout(quiet):
+            start = time.perf_counter()
+            ingest_video(video, store_dir)
+            timings['store ingest'] = time.perf_counter() - start
+        store = FrameStore(store_dir)
+        start = time.perf_counter()
+        identical = all(np.array_equal(a, b) for a, b in zip(store, tiff_frames)) and len(store) == len(tiff_frames)
+        timings['store read for flow'] = time.perf_counter() - start
+        start = time.perf_counter()
+        checksum -= sum(int(store.get(i)[0, 0]) for i in range(len(store)))
+        timings['store read for training'] = time.perf_counter() - start
+
+        tiff_files, tiff_bytes = _tree_size(tiff_dir)
+        store_files, store_bytes = _tree_size(store_dir)
+
+    print(f"[INFO] {frames} frames of {width}x{height}; identical grayscale frames: {identical and checksum == 0}")
+    for name, seconds in timings.items():
+        print(f"{name:<26}{seconds:>8.2f} s")
+    tiff_total = sum(v for k, v in timings.items() if k.startswith('tiff'))
+    store_total = sum(v for k, v in timings.items() if k.startswith('store'))
+    print(f"{'total':<26}{tiff_total:>8.2f} s (TIFF) vs {store_total:.2f} s (store), {tiff_total / store_total:.1f}x")
+    print(f"{'disk':<26}{tiff_files:>8} files, {tiff_bytes / 2**20:.1f} MiB (TIFF) vs "
+          f"{store_files} files, {store_bytes / 2**20:.1f} MiB (store)")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the feature extraction pipeline.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    p = subparsers.add_parser("allocations", help="Per-frame temporaries of the flow weighting in Feature_extractor.")
+    p.add_argument("--frames", type=int, default=1000)
+
+    p = subparsers.add_parser("poscal", help="poscal against the skimage label/regionprops reference.")
+    p.add_argument("--masks", type=int, default=200)
+
+    p = subparsers.add_parser("poscal-normal", help="poscalNormal at increasing component counts.")
+    p.add_argument("--repeats", type=int, default=5)
+
+    p = subparsers.add_parser("knn", help="Pickled KNN against the compact memory-mapped format.")
+    p.add_argument("--train-size", type=int, default=200000)
+    p.add_argument("--boxes", type=int, default=40)
+
+    p = subparsers.add_parser("models", help="Pickled SVM and logistic regression against their array exports.")
+    p.add_argument("--train-size", type=int, default=20000)
+    p.add_argument("--boxes", type=int, default=40)
+
+    p = subparsers.add_parser("service", help="Per-frame predict calls against the batched predict service at 1, 8 and 32 streams.")
+    p.add_argument("--model", choices=("knn", "svm", "sklearn-svm"), default="svm")
+    p.add_argument("--frames", type=int, default=100)
+    p.add_argument("--max-latency-ms", type=float, default=5.0)
+
+    p = subparsers.add_parser("pipeline", help="Sequential StreamDetector against the staged asyncio pipeline.")
+    p.add_argument("--frames", type=int, default=300)
+
+    p = subparsers.add_parser("flow-engines", help="ms/frame and downstream accuracy of every optical flow engine.")
+    p.add_argument("--dataset", type=str, default=None, help="Dataset folder with original_pics and ab_fg_pics (default: synthetic).")
+    p.add_argument("--frames", type=int, default=200)
+
+    p = subparsers.add_parser("warm-flow", help="Warm-started Farneback: speed against end-point error.")
+    p.add_argument("--dataset", type=str, default=None, help="Dataset folder with original_pics (default: synthetic).")
+    p.add_argument("--frames", type=int, default=200)
+
+    subparsers.add_parser("motion-gate", help="StreamDetector with and without the motion gate on a clip with quiet spells.")
+
+    p = subparsers.add_parser("roi-flow", help="Full-frame flow against foreground-ROI flow and tiled storage.")
+    p.add_argument("--frames", type=int, default=100)
+
+    p = subparsers.add_parser("scale", help="fps and accuracy of StreamDetector at 1.0, 0.75 and 0.5 processing scale.")
+    p.add_argument("--frames", type=int, default=200)
+
+    p = subparsers.add_parser("ingest", help="TIFF frame folders against the single-pass memory-mapped frame store.")
+    p.add_argument("--frames", type=int, default=1000)
+
+    args = parser.parse_args()
+    if args.benchmark == "allocations":
+        bench_allocations(args.frames)
+    elif args.benchmark == "poscal":
+        bench_poscal(args.masks)
+    elif args.benchmark == "poscal-normal":
+        bench_poscal_normal(repeats=args.repeats)
+    elif args.benchmark == "knn":
+        bench_knn(args.train_size, args.boxes)
+    elif args.benchmark == "models":
+        bench_models(args.train_size, args.boxes)
+    elif args.benchmark == "pipeline":
+        bench_pipeline(args.frames)
+    elif args.benchmark == "flow-engines":
+        bench_flow_engines(args.dataset, args.frames)
+    elif args.benchmark == "warm-flow":
+        bench_warm_flow(args.dataset, args.frames)
+    elif args.benchmark == "motion-gate":
+        bench_motion_gate()
+    elif args.benchmark == "roi-flow":
+        bench_roi_flow(frames=args.frames)
+    elif args.benchmark == "ingest":
+        bench_ingest(args.frames)
+    elif args.benchmark == "scale":
+        bench_scale(frames=args.frames)
+    elif args.benchmark == "service":
+        bench_service(args.model, frames=args.frames, max_latency=args.max_latency_ms / 1000.0)
@@ -4,7 +4,8 @@ import os
 def video_to_tiff_frames(video_path, output_folder):
     """
     Extracts frames from a video and saves them as sequentially numbered
-    TIFF images (e.g., 001.tif, 002.tif, etc.).
+    TIFF images (e.g., 001.tif, 002.tif, etc.). frame_store.py ingests a
+    video into a single memory-mapped frame store instead.
     """
     if not os.path.exists(video_path):
         print(f"Error: Video file not found at '{video_path}'")
@@ -1,14 +1,19 @@
 # core.py
 import cv2
 import os
-import scipy.io
+import argparse
 import numpy as np
 from sklearn.model_selection import train_test_split
 import joblib
 
 from weight_matrix import Weight_matrix
 from Feature_extraction import Feature_extractor
-from Classifiers import Classifiers
+from flow_store import load_flow, ConcatFlowView
+from frame_store import ConcatFrames, open_frame_store
+from feature_cache import FeatureCache, extraction_params
+from split import Spliter
+from Classifiers import Classifiers, StreamingSVM
+from model_store import export_model
 
 def load_all_datasets():
     """
@@ -36,40 +41,91 @@ def load_all_datasets():
         frames_dir = os.path.join(dataset_dir, 'frames')
         fg_dir = os.path.join(dataset_dir, 'fg_pics')
         ab_fg_dir = os.path.join(dataset_dir, 'ab_fg_pics')
-        flow_path = os.path.join(dataset_dir, 'optical_flow.mat')
 
-        if not os.path.exists(flow_path):
+        # Flow comes from the chunked store (memory-mapped) or a legacy optical_flow.mat
+        u_data, v_data = load_flow(dataset_dir)
+        if u_data is None:
             print(f"[WARNING] Optical flow not found for {name}. Skipping.")
             continue
 
         print(f"[INFO] Loading data from {name}...")
-        flow_data = scipy.io.loadmat(flow_path)
-        u_data = flow_data['u_flow']
-        v_data = flow_data['v_flow']
         
-        num_frames = u_data.shape[2] + 1
+        # Flow frame i pairs frame i with frame i+1, so each dataset contributes
+        # exactly one image path per flow frame and the lists stay aligned with
+        # the global flow index. The last frame of a clip has no flow.
+        num_frames = u_data.shape[2]
         
         all_u_data.append(u_data)
         all_v_data.append(v_data)
-        all_original_imgs.extend([os.path.join(frames_dir, f'{i+1:03d}.tif') for i in range(num_frames)])
-        all_fg_imgs.extend([os.path.join(fg_dir, f'{i+1:03d}.tif') for i in range(num_frames)])
+        # An ingested dataset reads its grayscale frames from the frame store,
+        # which also serves as the foreground pictures (see fg_pics.py)
+        store = open_frame_store(dataset_dir)
+        if store is not None:
+            all_original_imgs.append(store[:num_frames])
+            all_fg_imgs.append(store[:num_frames])
+        else:
+            all_original_imgs.append([os.path.join(frames_dir, f'{i+1:03d}.tif') for i in range(num_frames)])
+            all_fg_imgs.append([os.path.join(fg_dir, f'{i+1:03d}.tif') for i in range(num_frames)])
         all_ab_fg_imgs.extend([os.path.join(ab_fg_dir, f'{i+1:03d}.png') for i in range(num_frames)])
 
     if not all_u_data:
         print("[ERROR] No valid datasets were loaded. Exiting.")
         return [], [], [], [], [], [], 0
 
-    # We concatenate the flow data along the frame axis (the last axis)
-    combined_u = np.concatenate(all_u_data, axis=-1)
-    combined_v = np.concatenate(all_v_data, axis=-1)
+    # A virtual concatenation along the frame axis; nothing is copied
+    combined_u = ConcatFlowView(all_u_data)
+    combined_v = ConcatFlowView(all_v_data)
+    combined_fg = ConcatFrames(all_fg_imgs)
+    combined_original = ConcatFrames(all_original_imgs)
     
     total_frames = combined_u.shape[2] + 1
     print(f"[INFO] Successfully loaded and combined {len(all_u_data)} datasets.")
     print(f"[INFO] Total frames to process: {total_frames}")
 
-    return combined_u, combined_v, all_fg_imgs, all_original_imgs, all_ab_fg_imgs, datasets_root, total_frames
+    return combined_u, combined_v, combined_fg, combined_original, all_ab_fg_imgs, datasets_root, total_frames
 
-def main():
+def models_directory():
+    """The '../models' directory next to the code, created if needed."""
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    models_dir = os.path.join(os.path.dirname(script_dir), 'models')
+    os.makedirs(models_dir, exist_ok=True)
+    return models_dir
+
+def train_large(extractor, num_frames, models_dir, workers=1, holdout_every=5, max_test=50000):
+    """
+    Large-data path: streams feature chunks into a StreamingSVM instead of
+    extracting everything first. Every holdout_every-th chunk (up to
+    max_test rows) is held out to report the gap against an exact SVC
+    trained on a subsample.
+    """
+    test_X, test_y = [], []
+    held_out = set()
+
+    def train_chunks():
+        # The test chunks are picked on the first pass; only those are kept out of training
+        first_pass = not held_out and not test_y
+        for k, (X, y) in enumerate(extractor.iter_feature_chunks(0, num_frames, workers=workers)):
+            if k in held_out:
+                continue
+            if first_pass and k % holdout_every == holdout_every - 1 and sum(len(t) for t in test_y) < max_test:
+                held_out.add(k)
+                test_X.append(X)
+                test_y.append(y)
+                continue
+            yield X, y
+
+    # labeling() marks every box 0 (normal) or 1 (abnormal)
+    model = StreamingSVM(classes=(0, 1)).fit(train_chunks)
+    if test_y:
+        model.accuracy_gap(np.concatenate(test_X)[:max_test], np.concatenate(test_y)[:max_test])
+    else:
+        print(f"[WARNING] Fewer than {holdout_every} feature chunks; none held out for the accuracy gap report.")
+
+    filename = os.path.join(models_dir, 'streaming_svm_model.pkl')
+    joblib.dump(model, filename)
+    print(f"[SUCCESS] Saved streaming_svm model to {filename}")
+
+def main(workers=1, use_cache=True, large=False, scale=1.0):
     u_data, v_data, fg_imgs, original_imgs, ab_fg_imgs, ref_data_path, num_frames = load_all_datasets()
 
     if num_frames == 0 or u_data is None:
@@ -79,11 +135,23 @@ def main():
     frame_height = u_data.shape[0]
     weight = Weight_matrix(ref_data_path=ref_data_path, frame_height=frame_height).get_weight_matrix()
 
-    # The Feature Extractor now gets the combined data from all videos
-    thisFeatureExtractor = Feature_extractor(original_imgs, fg_imgs, ab_fg_imgs, u_data, v_data, weight)
+    # Unchanged frames are reused from the feature cache; see feature_cache.py
+    cache = None
+    if use_cache:
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        cache = FeatureCache(os.path.join(os.path.dirname(script_dir), 'feature_cache'), weight,
+                             extraction_params(Spliter(scale=scale)))
 
-    print(f"\n[INFO] Extracting features from all {num_frames} combined frames.")
-    all_features, all_labels, all_indices, _ = thisFeatureExtractor.get_features_and_labels_with_indices(0, num_frames)
+    # The Feature Extractor now gets the combined data from all videos; leaving
+    # the block stops its mask read-ahead threads
+    with Feature_extractor(original_imgs, fg_imgs, ab_fg_imgs, u_data, v_data, weight, cache=cache, scale=scale) as thisFeatureExtractor:
+        if large:
+            print(f"\n[INFO] Streaming features from all {num_frames} combined frames into the large-data SVM.")
+            train_large(thisFeatureExtractor, num_frames, models_directory(), workers=workers)
+            return
+
+        print(f"\n[INFO] Extracting features from all {num_frames} combined frames.")
+        all_features, all_labels, all_indices, _ = thisFeatureExtractor.get_features_and_labels_with_indices(0, num_frames, workers=workers)
 
     # (The rest of the main function remains the same)
     if all_features.size == 0:
@@ -109,18 +177,29 @@ def main():
     print("--- END DATA SPLIT ---\n")
 
     classifiers = Classifiers(train_data, train_labels)
+    classifiers.report(test_data, test_labels)
 
     # Save the newly trained models
     print("\n[INFO] Saving trained models to disk...")
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    base_dir = os.path.dirname(script_dir)
-    models_dir = os.path.join(base_dir, 'models')
-    os.makedirs(models_dir, exist_ok=True)
+    models_dir = models_directory()
     
     for name, model in classifiers.models.items():
         filename = os.path.join(models_dir, f'{name}_model.pkl')
         joblib.dump(model, filename)
         print(f"[SUCCESS] Saved {name} model to {filename}")
 
+        # The detector memory-maps these array directories instead of unpickling sklearn
+        export_dir = os.path.join(models_dir, f'{name}_model')
+        export_model(model, export_dir, train_data, train_labels)
+        print(f"[SUCCESS] Exported {name} model arrays to {export_dir}")
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Extract features from all datasets and train the classifiers.")
+    parser.add_argument("--workers", type=int, default=1, help="Processes used for feature extraction (default: 1).")
+    parser.add_argument("--no-cache", action="store_true", help="Re-extract every frame instead of using the feature cache.")
+    parser.add_argument("--large", action="store_true", help="Stream features into a Nystroem + SGD linear SVM instead of holding them all in RAM.")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="Extract features at this fraction of the frame resolution, e.g. 0.5 (default: 1.0).")
+    args = parser.parse_args()
+
+    main(workers=args.workers, use_cache=not args.no_cache, large=args.large, scale=args.scale)
\ No newline at end of file
@@ -0,0 +1,97 @@
+# feature_cache.py
+import os
+import json
+import hashlib
+import numpy as np
+
+import poscal
+from split import Spliter
+
+# Bump when the extraction code changes in a way the inputs do not capture
+CACHE_VERSION = 1
+
+def extraction_params(spliter=None, gate=0.5):
+    """The Spliter, poscal and labeling settings that the cached features depend on."""
+    spliter = spliter if spliter is not None else Spliter()
+    params = {
+        'spliter': {
+            'floor': spliter.floor,
+            'ceil': spliter.ceil,
+            'normal': Spliter.normal,
+            'heightNorm': Spliter.heightNorm,
+            'widthNorm': Spliter.widthNorm,
+        },
+        'poscal': {
+            'kernel_size': poscal.KERNEL_SIZE,
+            'iterations': poscal.MORPH_ITERATIONS,
+            'min_area': poscal.MIN_AREA,
+        },
+        'labeling_gate': gate,
+    }
+    # The scaled constants follow from these; the scale is only recorded when
+    # set, so caches written at full resolution stay valid
+    if spliter.scale != 1.0:
+        params['scale'] = spliter.scale
+    return params
+
+class FeatureCache(object):
+    """
+    On-disk cache of per-frame features, labels and positions. An entry is
+    keyed by a hash of the fg image file (or the fg pixels, for frames read
+    from a frame store), the ab_fg mask file, the u/v flow frame, the weight
+    matrix and the extraction parameters, so changing any input or setting
+    simply misses and recomputes that frame. Because the flow itself is
+    hashed, a hit still reads the u/v frame from the flow store; it saves
+    the box and feature extraction, not the flow I/O.
+    """
+
+    def __init__(self, cache_dir, weight, params=None):
+        self.cache_dir = cache_dir
+        self.params = params if params is not None else extraction_params()
+
+        base = hashlib.blake2b(digest_size=20)
+        base.update(f'v{CACHE_VERSION}'.encode())
+        base.update(json.dumps(self.params, sort_keys=True).encode())
+        base.update(np.ascontiguousarray(weight, dtype=np.float64).tobytes())
+        self._base_digest = base.digest()
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, fg_path, ab_path, u, v):
+        h = hashlib.blake2b(self._base_digest, digest_size=20)
+        for path in (fg_path, ab_path):
+            if isinstance(path, np.ndarray):
+                h.update(np.ascontiguousarray(path).tobytes())
+            elif os.path.exists(path):
+                with open(path, 'rb') as f:
+                    h.update(f.read())
+            else:
+                h.update(b'missing')
+        h.update(np.ascontiguousarray(u).tobytes())
+        h.update(np.ascontiguousarray(v).tobytes())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.npz')
+
+    def load(self, key):
+        """Returns (features, labels, positions) for key, or None on a miss."""
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                entry = data['features'], data['labels'], data['positions']
+        except (OSError, ValueError, KeyError):
+            # A truncated or foreign file is treated as a miss and rewritten
+            return None
+        return entry
+
+    def store(self, key, features, labels, positions):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so parallel workers never see half a file
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, features=features, labels=labels, positions=positions)
+        os.replace(tmp_path, path)
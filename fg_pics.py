@@ -4,7 +4,8 @@ import os
 def generate_fg_pics(src_dir, dst_dir):
     """
     Reads all TIFF images from a source directory, converts them to grayscale,
-    and saves them to a destination directory.
+    and saves them to a destination directory. Not needed for datasets
+    ingested with frame_store.py, whose grayscale frames are read directly.
     """
     os.makedirs(dst_dir, exist_ok=True)
     print("[INFO] Generating FG pics from original_pics...")
@@ -0,0 +1,225 @@
+# flow_engines.py
+import cv2
+import numpy as np
+
+from poscal import poscal
+
+class FarnebackEngine(object):
+    """Dense Farneback flow with the parameters the project has always used."""
+    name = 'farneback'
+
+    def __init__(self, pyr_scale=0.5, levels=3, winsize=15, iterations=3, poly_n=5, poly_sigma=1.2, flags=0):
+        self.params = (pyr_scale, levels, winsize, iterations, poly_n, poly_sigma, flags)
+
+    def compute(self, prev_gray, next_gray):
+        """(height, width, 2) float32 flow from prev_gray to next_gray."""
+        return cv2.calcOpticalFlowFarneback(prev_gray, next_gray, None, *self.params)
+
+    def reset(self):
+        """Engines that carry state between frames forget it here; this one has none."""
+
+class WarmFarnebackEngine(FarnebackEngine):
+    """
+    Farneback that starts each frame pair from the previous flow field
+    (OPTFLOW_USE_INITIAL_FLOW) with fewer pyramid levels and iterations,
+    since consecutive fields barely change. Every refresh_every frames, and
+    after reset(), the full cold computation runs again to bound drift.
+    Calls must come in frame order; use one engine per sequence.
+    """
+    name = 'farneback-warm'
+
+    def __init__(self, warm_levels=1, warm_iterations=1, refresh_every=10, **cold_params):
+        super(WarmFarnebackEngine, self).__init__(**cold_params)
+        pyr_scale, _, winsize, _, poly_n, poly_sigma, flags = self.params
+        self.warm_params = (pyr_scale, warm_levels, winsize, warm_iterations, poly_n, poly_sigma,
+                            flags | cv2.OPTFLOW_USE_INITIAL_FLOW)
+        self.refresh_every = refresh_every
+        self._flow = None
+        self._since_cold = 0
+
+    def compute(self, prev_gray, next_gray):
+        if self._flow is None or self._since_cold >= self.refresh_every or self._flow.shape[:2] != prev_gray.shape:
+            flow = cv2.calcOpticalFlowFarneback(prev_gray, next_gray, None, *self.params)
+            self._since_cold = 1
+        else:
+            # The initial flow is refined in place, so start from a copy the caller never sees
+            flow = cv2.calcOpticalFlowFarneback(prev_gray, next_gray, self._flow.copy(), *self.warm_params)
+            self._since_cold += 1
+        self._flow = flow
+        return flow
+
+    def reset(self):
+        self._flow = None
+        self._since_cold = 0
+
+class DISEngine(object):
+    """
+    Dense Inverse Search flow (cv2.DISOpticalFlow) at one of its presets:
+    'ultrafast', 'fast' or 'medium'. The OpenCV object is created on first
+    use and not pickled, so engines can be handed to worker processes.
+    """
+    PRESETS = {
+        'ultrafast': cv2.DISOPTICAL_FLOW_PRESET_ULTRAFAST,
+        'fast': cv2.DISOPTICAL_FLOW_PRESET_FAST,
+        'medium': cv2.DISOPTICAL_FLOW_PRESET_MEDIUM,
+    }
+
+    def __init__(self, preset='fast'):
+        if preset not in DISEngine.PRESETS:
+            raise ValueError(f"Unknown DIS preset {preset!r}; expected one of {sorted(DISEngine.PRESETS)}")
+        self.preset = preset
+        self.name = f'dis-{preset}'
+        self._dis = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_dis'] = None
+        return state
+
+    def compute(self, prev_gray, next_gray):
+        if self._dis is None:
+            self._dis = cv2.DISOpticalFlow_create(DISEngine.PRESETS[self.preset])
+        return self._dis.calc(prev_gray, next_gray, None)
+
+    def reset(self):
+        pass
+
+class SparseLKEngine(object):
+    """
+    Pyramidal Lucas-Kanade tracked only on a grid of points inside the poscal
+    blobs of the previous frame: mask pixels inside one of the boxes poscal
+    returns, so specks below its minimum area are skipped. getFeaturesUV
+    only ever averages flow inside boxes cut from those blobs. Each tracked
+    point's flow fills its grid_step x grid_step cell of the returned dense
+    field; everything outside the blobs, and points LK loses, stay 0. scale
+    is the processing scale of the frames it gets, passed on to poscal.
+    """
+    name = 'sparse-lk'
+
+    def __init__(self, grid_step=4, win_size=15, max_level=2, scale=1.0):
+        self.grid_step = grid_step
+        self.win_size = win_size
+        self.max_level = max_level
+        self.scale = scale
+
+    def compute(self, prev_gray, next_gray):
+        height, width = prev_gray.shape
+        step = self.grid_step
+        flow = np.zeros((height, width, 2), dtype=np.float32)
+
+        positions, mask = poscal(prev_gray, self.scale)
+        # Cell centres that fall inside a blob poscal kept
+        rows = np.arange(step // 2, height, step)
+        cols = np.arange(step // 2, width, step)
+        in_box = np.zeros((rows.size, cols.size), dtype=bool)
+        for max_r, min_r, max_c, min_c, _ in positions.astype(int):
+            in_box[np.ix_((rows >= min_r) & (rows < max_r), (cols >= min_c) & (cols < max_c))] = True
+        inside = in_box & (mask[np.ix_(rows, cols)] != 0)
+        if not inside.any():
+            return flow
+        cell_r, cell_c = np.nonzero(inside)
+        points = np.stack([cols[cell_c], rows[cell_r]], axis=1).astype(np.float32).reshape((-1, 1, 2))
+
+        moved, status, _ = cv2.calcOpticalFlowPyrLK(prev_gray, next_gray, points, None,
+                                                    winSize=(self.win_size, self.win_size), maxLevel=self.max_level)
+        found = status[:, 0] == 1
+        grid = np.zeros((rows.size, cols.size, 2), dtype=np.float32)
+        grid[cell_r[found], cell_c[found]] = (moved - points)[found, 0]
+
+        # Cell (i, j) covers pixels [i*step, (i+1)*step) x [j*step, (j+1)*step)
+        dense = np.repeat(np.repeat(grid, step, axis=0), step, axis=1)
+        flow[:] = dense[:height, :width]
+        return flow
+
+    def reset(self):
+        pass
+
+def merge_regions(regions):
+    """Merges overlapping or touching (y0, y1, x0, x1) rectangles until none overlap."""
+    regions = [list(r) for r in regions]
+    merged = True
+    while merged:
+        merged = False
+        out = []
+        for r in regions:
+            for o in out:
+                if r[0] <= o[1] and o[0] <= r[1] and r[2] <= o[3] and o[2] <= r[3]:
+                    o[0], o[1], o[2], o[3] = min(o[0], r[0]), max(o[1], r[1]), min(o[2], r[2]), max(o[3], r[3])
+                    merged = True
+                    break
+            else:
+                out.append(r)
+        regions = out
+    return [tuple(r) for r in regions]
+
+def _grow(start, end, min_size, limit):
+    """Clips [start, end) to [0, limit), widened to min_size where the frame allows (pyramid support)."""
+    missing = max(min_size - (end - start), 0)
+    start, end = start - missing // 2, end + missing - missing // 2
+    if start < 0:
+        start, end = 0, end - start
+    if end > limit:
+        start, end = start - (end - limit), limit
+    return (max(start, 0), end)
+
+class RoiFlowEngine(object):
+    """
+    Runs another engine only on the foreground: the poscal blobs of the
+    previous frame, each bounding box grown by `pad` pixels and to at least
+    min_size on each side (room for the pyramid and the search window; near
+    a frame edge the region grows inwards) and merged where they overlap. Returns a
+    full-size field that is 0 outside the regions; the regions of the last
+    call are kept in last_regions as (y0, y1, x0, x1) for tiled storage.
+    scale is the processing scale of the frames it gets, passed on to poscal;
+    pad and min_size are in native pixels and shrink with it.
+    """
+
+    def __init__(self, engine, pad=24, min_size=64, scale=1.0):
+        self.engine = engine
+        self.pad = max(1, round(pad * scale))
+        self.min_size = max(1, round(min_size * scale))
+        self.scale = scale
+        self.name = f'roi-{engine.name}'
+        self.last_regions = []
+
+    def regions(self, gray):
+        positions, _ = poscal(gray, self.scale)
+        height, width = gray.shape
+        p = self.pad
+        return merge_regions([_grow(int(min_r) - p, int(max_r) + p, self.min_size, height) +
+                              _grow(int(min_c) - p, int(max_c) + p, self.min_size, width)
+                              for max_r, min_r, max_c, min_c, _ in positions])
+
+    def compute(self, prev_gray, next_gray):
+        flow = np.zeros(prev_gray.shape + (2,), dtype=np.float32)
+        self.last_regions = self.regions(prev_gray)
+        for y0, y1, x0, x1 in self.last_regions:
+            # Crops are copied: DIS only accepts contiguous images
+            flow[y0:y1, x0:x1] = self.engine.compute(np.ascontiguousarray(prev_gray[y0:y1, x0:x1]),
+                                                     np.ascontiguousarray(next_gray[y0:y1, x0:x1]))
+        return flow
+
+    def reset(self):
+        # Regions move and change size, so a warm start across frames does not apply
+        self.engine.reset()
+
+# DIS rebuilds its buffers for every new image size, so it is not offered on ROI crops
+ENGINES = ('farneback', 'farneback-warm', 'dis-ultrafast', 'dis-fast', 'dis-medium', 'sparse-lk', 'roi-farneback')
+
+def make_engine(name, scale=1.0):
+    """
+    The flow engine for a CLI name (see ENGINES); 'roi-<name>' runs <name> on
+    the foreground only. scale is the processing scale of the frames (see
+    StreamDetector), for the engines that find blobs with poscal.
+    """
+    if name.startswith('roi-'):
+        return RoiFlowEngine(make_engine(name[len('roi-'):], scale), scale=scale)
+    if name == 'farneback':
+        return FarnebackEngine()
+    if name == 'farneback-warm':
+        return WarmFarnebackEngine()
+    if name.startswith('dis-'):
+        return DISEngine(name[len('dis-'):])
+    if name == 'sparse-lk':
+        return SparseLKEngine(scale=scale)
+    raise ValueError(f"Unknown flow engine {name!r}; expected one of {', '.join(ENGINES)}")
@@ -0,0 +1,436 @@
+# flow_store.py
+import os
+import abc
+import json
+import numpy as np
+import scipy.io
+
+INDEX_NAME = 'index.json'
+STORE_NAME = 'optical_flow'     # directory name inside a dataset folder
+LEGACY_NAME = 'optical_flow.mat'
+
+class FlowStoreWriter(object):
+    """
+    Appends flow frames to a chunked on-disk store. Every chunk is one .npy
+    file of shape (count, 2, height, width) float32 holding u and v, and
+    index.json lists the chunks. The index is rewritten after each chunk, so
+    memory stays bounded by one chunk however long the clip is.
+    """
+
+    def __init__(self, path, chunk_size=64, engine='farneback'):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.engine = engine
+        self.chunks = []
+        self.num_frames = 0
+        self.height = None
+        self.width = None
+        self._buffer = None
+        self._count = 0
+
+        os.makedirs(path, exist_ok=True)
+        # Start from an empty store; stale chunks from a previous run are replaced
+        for name in os.listdir(path):
+            if name == INDEX_NAME or (name.startswith('flow_') and name.endswith('.npy')):
+                os.remove(os.path.join(path, name))
+
+    def append(self, u, v):
+        if self._buffer is None:
+            self.height, self.width = u.shape
+            self._buffer = np.empty((self.chunk_size, 2, self.height, self.width), dtype=np.float32)
+        elif u.shape != (self.height, self.width):
+            raise ValueError(f"Flow frame shape {u.shape} does not match the store shape {(self.height, self.width)}")
+
+        self._buffer[self._count, 0] = u
+        self._buffer[self._count, 1] = v
+        self._count += 1
+        self.num_frames += 1
+        if self._count == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self._count == 0:
+            return
+        name = f'flow_{len(self.chunks):05d}.npy'
+        np.save(os.path.join(self.path, name), self._buffer[:self._count])
+        self.chunks.append({'file': name, 'start': self.num_frames - self._count, 'count': self._count})
+        self._count = 0
+        self._write_index()
+
+    def close(self):
+        if self.num_frames == 0:
+            raise ValueError(f"No flow frames were written to {self.path}; a flow store needs at least one frame")
+        self.flush()
+        self._write_index()
+
+    def _write_index(self):
+        index = {
+            'height': self.height,
+            'width': self.width,
+            'dtype': 'float32',
+            'engine': self.engine,
+            'num_frames': self.num_frames,
+            'chunks': self.chunks,
+        }
+        tmp_path = os.path.join(self.path, INDEX_NAME + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, os.path.join(self.path, INDEX_NAME))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # An empty store is only reported when nothing else went wrong first
+        if exc_type is None or self.num_frames:
+            self.close()
+
+
+class FlowStore(object):
+    """
+    Read side of a FlowStoreWriter directory. Chunks are memory-mapped on
+    first use, so reading one frame only touches the pages of that frame.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_NAME)) as f:
+            index = json.load(f)
+        self.height = index['height']
+        self.width = index['width']
+        self.num_frames = index['num_frames']
+        if not self.num_frames:
+            raise ValueError(f"Flow store {path} holds no frames")
+        self.engine = index.get('engine', 'farneback')   # stores written before engines were selectable
+        self.chunks = index['chunks']
+        self._starts = np.array([c['start'] for c in self.chunks], dtype=np.int64)
+        self._maps = {}
+
+        self.U = FlowArray(self, 0)
+        self.V = FlowArray(self, 1)
+
+    def __getstate__(self):
+        # Memory maps are reopened on the other side instead of being pickled
+        state = self.__dict__.copy()
+        state['_maps'] = {}
+        return state
+
+    def _chunk(self, chunk_index):
+        data = self._maps.get(chunk_index)
+        if data is None:
+            data = np.load(os.path.join(self.path, self.chunks[chunk_index]['file']), mmap_mode='r')
+            self._maps[chunk_index] = data
+        return data
+
+    def frame(self, i, component):
+        """Returns frame i of u (component 0) or v (component 1) as a read-only view."""
+        if i < 0:
+            i += self.num_frames
+        if not 0 <= i < self.num_frames:
+            raise IndexError(f"Flow frame {i} out of range for a store of {self.num_frames} frames")
+        chunk_index = int(np.searchsorted(self._starts, i, side='right')) - 1
+        return self._chunk(chunk_index)[i - self.chunks[chunk_index]['start'], component]
+
+
+class TiledFlowStoreWriter(object):
+    """
+    Sparse variant of FlowStoreWriter for flow computed only in regions of
+    the frame (flow_engines.RoiFlowEngine). Frames are cut into
+    tile_size x tile_size tiles and only tiles touching a region are kept.
+    Per chunk, tiles_NNNNN.npy is (tiles, 2, tile_size, tile_size) float32,
+    tilepos_NNNNN.npy their (row, col) in the tile grid and
+    frames_NNNNN.npy the offset of each frame's first tile.
+    """
+
+    def __init__(self, path, chunk_size=64, tile_size=16, engine='roi-farneback'):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.tile_size = tile_size
+        self.engine = engine
+        self.chunks = []
+        self.num_frames = 0
+        self.stored_tiles = 0
+        self.height = None
+        self.width = None
+        self._tiles = []
+        self._positions = []
+        self._offsets = [0]
+
+        os.makedirs(path, exist_ok=True)
+        for name in os.listdir(path):
+            if name == INDEX_NAME or (name.endswith('.npy') and name.startswith(('flow_', 'tiles_', 'tilepos_', 'frames_'))):
+                os.remove(os.path.join(path, name))
+
+    def append(self, u, v, regions):
+        """Adds one frame; regions are (y0, y1, x0, x1) rectangles, flow outside them is taken as 0."""
+        if self.height is None:
+            self.height, self.width = u.shape
+        elif u.shape != (self.height, self.width):
+            raise ValueError(f"Flow frame shape {u.shape} does not match the store shape {(self.height, self.width)}")
+
+        t = self.tile_size
+        rows, cols = -(-self.height // t), -(-self.width // t)
+        keep = np.zeros((rows, cols), dtype=bool)
+        for y0, y1, x0, x1 in regions:
+            if y1 > y0 and x1 > x0:
+                keep[y0 // t:-(-y1 // t), x0 // t:-(-x1 // t)] = True
+        tile_r, tile_c = np.nonzero(keep)
+
+        if tile_r.size:
+            padded = np.zeros((2, rows * t, cols * t), dtype=np.float32)
+            padded[0, :self.height, :self.width] = u
+            padded[1, :self.height, :self.width] = v
+            grid = padded.reshape((2, rows, t, cols, t)).transpose(1, 3, 0, 2, 4)
+            self._tiles.append(grid[tile_r, tile_c])
+            self._positions.append(np.stack([tile_r, tile_c], axis=1).astype(np.int32))
+        self._offsets.append(self._offsets[-1] + tile_r.size)
+        self.stored_tiles += tile_r.size
+        self.num_frames += 1
+        if len(self._offsets) - 1 == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        count = len(self._offsets) - 1
+        if count == 0:
+            return
+        t = self.tile_size
+        k = len(self.chunks)
+        tiles = np.concatenate(self._tiles) if self._tiles else np.zeros((0, 2, t, t), dtype=np.float32)
+        positions = np.concatenate(self._positions) if self._positions else np.zeros((0, 2), dtype=np.int32)
+        np.save(os.path.join(self.path, f'tiles_{k:05d}.npy'), tiles)
+        np.save(os.path.join(self.path, f'tilepos_{k:05d}.npy'), positions)
+        np.save(os.path.join(self.path, f'frames_{k:05d}.npy'), np.array(self._offsets, dtype=np.int64))
+        self.chunks.append({'file': f'tiles_{k:05d}.npy', 'positions': f'tilepos_{k:05d}.npy',
+                            'offsets': f'frames_{k:05d}.npy', 'start': self.num_frames - count, 'count': count})
+        self._tiles, self._positions, self._offsets = [], [], [0]
+        self._write_index()
+
+    def close(self):
+        if self.num_frames == 0:
+            raise ValueError(f"No flow frames were written to {self.path}; a flow store needs at least one frame")
+        self.flush()
+        self._write_index()
+
+    def _write_index(self):
+        index = {
+            'layout': 'tiled',
+            'height': self.height,
+            'width': self.width,
+            'dtype': 'float32',
+            'engine': self.engine,
+            'tile_size': self.tile_size,
+            'num_frames': self.num_frames,
+            'chunks': self.chunks,
+        }
+        tmp_path = os.path.join(self.path, INDEX_NAME + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, os.path.join(self.path, INDEX_NAME))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None or self.num_frames:
+            self.close()
+
+
+class TiledFlowStore(FlowStore):
+    """
+    Read side of a TiledFlowStoreWriter directory. frame() rebuilds the full
+    frame (zeros outside the stored tiles), so .U and .V look exactly like a
+    dense store's to Feature_extractor. The last rebuilt frame is kept, as u
+    and v of the same frame are usually read one after the other.
+    """
+
+    def __init__(self, path):
+        super(TiledFlowStore, self).__init__(path)
+        with open(os.path.join(path, INDEX_NAME)) as f:
+            self.tile_size = json.load(f)['tile_size']
+        self._last = (None, None)
+
+    def __getstate__(self):
+        state = super(TiledFlowStore, self).__getstate__()
+        state['_last'] = (None, None)
+        return state
+
+    def _chunk(self, chunk_index):
+        data = self._maps.get(chunk_index)
+        if data is None:
+            chunk = self.chunks[chunk_index]
+            data = tuple(np.load(os.path.join(self.path, chunk[key]), mmap_mode='r')
+                         for key in ('file', 'positions', 'offsets'))
+            self._maps[chunk_index] = data
+        return data
+
+    def frame(self, i, component):
+        if i < 0:
+            i += self.num_frames
+        if not 0 <= i < self.num_frames:
+            raise IndexError(f"Flow frame {i} out of range for a store of {self.num_frames} frames")
+
+        last_index, dense = self._last
+        if last_index != i:
+            chunk_index = int(np.searchsorted(self._starts, i, side='right')) - 1
+            tiles, positions, offsets = self._chunk(chunk_index)
+            local = i - self.chunks[chunk_index]['start']
+            first, end = offsets[local], offsets[local + 1]
+
+            t = self.tile_size
+            rows, cols = -(-self.height // t), -(-self.width // t)
+            padded = np.zeros((2, rows * t, cols * t), dtype=np.float32)
+            grid = padded.reshape((2, rows, t, cols, t)).transpose(1, 3, 0, 2, 4)
+            grid[positions[first:end, 0], positions[first:end, 1]] = tiles[first:end]
+            dense = padded[:, :self.height, :self.width]
+            dense.flags.writeable = False
+            self._last = (i, dense)
+        return dense[component]
+
+
+def open_flow_store(path):
+    """A FlowStore or TiledFlowStore, whichever layout the index at path describes."""
+    with open(os.path.join(path, INDEX_NAME)) as f:
+        layout = json.load(f).get('layout', 'dense')
+    return TiledFlowStore(path) if layout == 'tiled' else FlowStore(path)
+
+
+class _LazyFlowArray(abc.ABC):
+    """
+    A (height, width, frames) array-like whose frames are fetched one at a
+    time by _frame(i), so code written for the loadmat arrays (U.shape,
+    U[:, :, i]) keeps working without materialising the whole tensor.
+    Subclasses set shape and dtype and implement _frame.
+    """
+
+    ndim = 3
+
+    @abc.abstractmethod
+    def _frame(self, i):
+        """Frame i as a (height, width) array."""
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        rows, cols, frames = key
+
+        if isinstance(frames, (int, np.integer)):
+            return self._frame(int(frames))[rows, cols]
+
+        frame_ids = np.arange(self.shape[2])[frames]
+        return np.stack([self._frame(int(i))[rows, cols] for i in frame_ids], axis=-1)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[:, :, :]
+        return data if dtype is None else data.astype(dtype)
+
+
+class FlowArray(_LazyFlowArray):
+    """One component (u or v) of a FlowStore."""
+
+    def __init__(self, store, component):
+        self.store = store
+        self.component = component
+        self.shape = (store.height, store.width, store.num_frames)
+        self.dtype = np.dtype(np.float32)
+
+    def _frame(self, i):
+        return self.store.frame(i, self.component)
+
+
+class NpyFlowArray(_LazyFlowArray):
+    """
+    One flow component spilled to a (frames, height, width) .npy file and
+    memory-mapped. Pickles as its path, so worker processes share the pages.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._map = None
+        frames, height, width = self._data().shape
+        self.shape = (height, width, frames)
+        self.dtype = self._data().dtype
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_map'] = None
+        return state
+
+    def _data(self):
+        if self._map is None:
+            self._map = np.load(self.path, mmap_mode='r')
+        return self._map
+
+    def _frame(self, i):
+        return self._data()[i]
+
+
+class ConcatFlowView(_LazyFlowArray):
+    """
+    Virtual concatenation of several datasets' flow arrays along the frame
+    axis. A global frame index is mapped to (dataset, local frame) without
+    copying, so adding a dataset costs no extra memory or load time.
+    """
+
+    def __init__(self, parts):
+        if not parts:
+            raise ValueError("ConcatFlowView needs at least one flow array")
+        height, width = parts[0].shape[:2]
+        for part in parts:
+            if part.shape[:2] != (height, width):
+                raise ValueError(f"Cannot combine flow of shape {part.shape[:2]} with {(height, width)}")
+
+        self.parts = parts
+        counts = [part.shape[2] for part in parts]
+        self.offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        self.shape = (height, width, int(self.offsets[-1]))
+        self.dtype = np.result_type(*[part.dtype for part in parts])
+
+    def locate(self, i):
+        """Maps a global frame index to (dataset index, local frame index)."""
+        if i < 0:
+            i += self.shape[2]
+        if not 0 <= i < self.shape[2]:
+            raise IndexError(f"Flow frame {i} out of range for a view of {self.shape[2]} frames")
+        dataset = int(np.searchsorted(self.offsets, i, side='right')) - 1
+        return dataset, i - int(self.offsets[dataset])
+
+    def _frame(self, i):
+        dataset, local = self.locate(i)
+        return self.parts[dataset][:, :, local]
+
+
+def spill_flow(flow, path):
+    """
+    Writes a (height, width, frames) flow array to path one frame at a time
+    and returns it as an NpyFlowArray.
+    """
+    height, width, frames = flow.shape
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=flow.dtype, shape=(frames, height, width))
+    for i in range(frames):
+        out[i] = flow[:, :, i]
+    out.flush()
+    del out
+    return NpyFlowArray(path)
+
+
+def load_flow(dataset_dir):
+    """
+    Returns the (U, V) flow of a dataset folder: lazily from the chunked
+    (dense or tiled) store when present, otherwise fully from the legacy optical_flow.mat.
+    Returns (None, None) if the dataset has no flow.
+    """
+    store_path = os.path.join(dataset_dir, STORE_NAME)
+    if os.path.exists(os.path.join(store_path, INDEX_NAME)):
+        store = open_flow_store(store_path)
+        return store.U, store.V
+
+    mat_path = os.path.join(dataset_dir, LEGACY_NAME)
+    if os.path.exists(mat_path):
+        flow_data = scipy.io.loadmat(mat_path)
+        return flow_data['u_flow'], flow_data['v_flow']
+
+    return None, None
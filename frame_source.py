@@ -0,0 +1,87 @@
+# frame_source.py
+import cv2
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+class ImageSource(object):
+    """
+    Indexed access to a list of image files, decoded as single-channel uint8
+    (IMREAD_GRAYSCALE). Frames after the last requested one are read ahead by
+    a background thread, and recently used frames stay in a bounded LRU, so the
+    training loop neither waits on each small file nor stats it first.
+    Missing or unreadable files come back as None, like cv2.imread; which
+    files exist is learned from one listing per directory, not a stat per frame.
+    Returned arrays are shared with the cache and must not be modified.
+    """
+
+    def __init__(self, paths, prefetch=8, cache_size=32, flags=cv2.IMREAD_GRAYSCALE):
+        self.paths = paths
+        self.prefetch = prefetch
+        self.cache_size = max(cache_size, 1)
+        self.flags = flags
+
+        self._listings = {}
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='image_prefetch') if prefetch > 0 else None
+
+    def __len__(self):
+        return len(self.paths)
+
+    def _exists(self, path):
+        directory, name = os.path.split(path)
+        listing = self._listings.get(directory)
+        if listing is None:
+            try:
+                listing = frozenset(os.listdir(directory or '.'))
+            except OSError:
+                listing = frozenset()
+            self._listings[directory] = listing
+        return name in listing
+
+    def _read(self, index):
+        path = self.paths[index]
+        if not self._exists(path):
+            return None
+        return cv2.imread(path, self.flags)
+
+    def get(self, index):
+        with self._lock:
+            if index in self._cache:
+                self._cache.move_to_end(index)
+                img = self._cache[index]
+                future = None
+                hit = True
+            else:
+                future = self._pending.pop(index, None)
+                hit = False
+
+        if not hit:
+            img = future.result() if future is not None else self._read(index)
+            with self._lock:
+                self._cache[index] = img
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        self._schedule(index)
+        return img
+
+    def _schedule(self, index):
+        """Queues the next `prefetch` frames and drops read-aheads that fell out of the window."""
+        if self._pool is None:
+            return
+        window = range(index + 1, min(index + 1 + self.prefetch, len(self.paths)))
+        with self._lock:
+            for stale in [k for k in self._pending if k not in window]:
+                self._pending.pop(stale).cancel()
+            for k in window:
+                if k not in self._cache and k not in self._pending:
+                    self._pending[k] = self._pool.submit(self._read, k)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -0,0 +1,224 @@
+# frame_store.py
+import os
+import cv2
+import json
+import time
+import argparse
+import numpy as np
+
+from frame_source import ImageSource
+
+INDEX_NAME = 'index.json'
+DATA_NAME = 'frames.u8'
+STORE_NAME = 'frame_store'      # directory name inside a dataset folder
+
+class FrameStoreWriter(object):
+    """
+    Appends grayscale frames to a single raw uint8 file, frame after frame
+    (frames, height, width), with index.json holding its shape. The index is
+    removed when writing starts and only written by close(), so a store cut
+    short by a crash is not mistaken for a complete one.
+    """
+
+    def __init__(self, path, fps=None, source=None):
+        self.path = path
+        self.fps = fps
+        self.source = source
+        self.num_frames = 0
+        self.height = None
+        self.width = None
+
+        os.makedirs(path, exist_ok=True)
+        index_path = os.path.join(path, INDEX_NAME)
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        self._file = open(os.path.join(path, DATA_NAME), 'wb')
+
+    def append(self, gray):
+        if self.height is None:
+            self.height, self.width = gray.shape
+        elif gray.shape != (self.height, self.width):
+            raise ValueError(f"Frame shape {gray.shape} does not match the store shape {(self.height, self.width)}")
+        self._file.write(np.ascontiguousarray(gray, dtype=np.uint8).data)
+        self.num_frames += 1
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        index = {
+            'height': self.height,
+            'width': self.width,
+            'dtype': 'uint8',
+            'num_frames': self.num_frames,
+            'fps': self.fps,
+            'source': self.source,
+        }
+        tmp_path = os.path.join(self.path, INDEX_NAME + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, os.path.join(self.path, INDEX_NAME))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FrameStore(object):
+    """
+    Read side of a FrameStoreWriter directory, memory-mapped on first use.
+    store[i] is frame i as a read-only (height, width) view, store[a:b] a
+    FrameStore over those frames only, and iterating yields the frames in
+    order. get(i) returns None past the end, like ImageSource does for a
+    missing file. Pickles as its path and range, so worker processes share
+    the pages instead of receiving copies.
+    """
+
+    def __init__(self, path, start=0, stop=None):
+        self.path = path
+        with open(os.path.join(path, INDEX_NAME)) as f:
+            index = json.load(f)
+        self.height = index['height']
+        self.width = index['width']
+        self.fps = index.get('fps')
+        self.total_frames = index['num_frames']
+        self.start = start
+        self.stop = self.total_frames if stop is None else min(stop, self.total_frames)
+        self._map = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_map'] = None
+        return state
+
+    def _data(self):
+        if self._map is None:
+            self._map = np.memmap(os.path.join(self.path, DATA_NAME), dtype=np.uint8, mode='r',
+                                  shape=(self.total_frames, self.height, self.width))
+        return self._map
+
+    def __len__(self):
+        return max(self.stop - self.start, 0)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError("FrameStore slices must be contiguous")
+            return FrameStore(self.path, self.start + start, self.start + max(stop, start))
+        i = int(key)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"Frame {key} out of range for a store of {len(self)} frames")
+        return self._data()[self.start + i]
+
+    def __iter__(self):
+        data = self._data()
+        for i in range(self.start, self.stop):
+            yield data[i]
+
+    def get(self, index):
+        return self[index] if 0 <= index < len(self) else None
+
+    def close(self):
+        self._map = None
+
+
+class ConcatFrames(object):
+    """
+    The frames of several datasets end to end, each part either a FrameStore
+    or a list of image paths (read through an ImageSource). frames[i] is the
+    path of frame i, or its pixels when it comes from a store, which is what
+    the feature cache hashes; get(i) is the decoded grayscale frame.
+    """
+
+    def __init__(self, parts):
+        self.parts = parts
+        counts = [len(part) for part in parts]
+        self.offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        self._sources = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_sources'] = {}
+        return state
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def locate(self, i):
+        """Maps a global frame index to (part index, local frame index)."""
+        if not 0 <= i < len(self):
+            raise IndexError(f"Frame {i} out of range for {len(self)} frames")
+        part = int(np.searchsorted(self.offsets, i, side='right')) - 1
+        return part, i - int(self.offsets[part])
+
+    def __getitem__(self, i):
+        part, local = self.locate(i)
+        return self.parts[part][local]
+
+    def get(self, i):
+        part, local = self.locate(i)
+        if isinstance(self.parts[part], FrameStore):
+            return self.parts[part][local]
+        source = self._sources.get(part)
+        if source is None:
+            source = self._sources[part] = ImageSource(self.parts[part])
+        return source.get(local)
+
+    def close(self):
+        for source in self._sources.values():
+            source.close()
+        self._sources = {}
+
+
+def open_frame_store(dataset_dir):
+    """The FrameStore of a dataset folder, or None if it has not been ingested."""
+    store_path = os.path.join(dataset_dir, STORE_NAME)
+    if os.path.exists(os.path.join(store_path, INDEX_NAME)):
+        return FrameStore(store_path)
+    return None
+
+
+def ingest_video(video_path, output_path):
+    """
+    Decodes video_path once and writes its frames, converted to grayscale,
+    into a FrameStore at output_path. This replaces convert_to_tif.py and
+    fg_pics.py: optical flow and feature extraction read the store directly.
+    Returns the number of frames written.
+    """
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        print(f"[ERROR] Could not open video file '{video_path}'")
+        return 0
+
+    fps = cap.get(cv2.CAP_PROP_FPS) or None
+    with FrameStoreWriter(output_path, fps=fps, source=os.path.basename(video_path)) as writer:
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            writer.append(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim > 2 else frame)
+            if writer.num_frames % 100 == 0:
+                print(f"\r[INFO] Ingested {writer.num_frames} frames...", end="", flush=True)
+    cap.release()
+    print(f"\r[INFO] Ingested {writer.num_frames} frames of {writer.width}x{writer.height}.")
+    return writer.num_frames
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Decode a video once into a dataset's grayscale frame store.")
+    parser.add_argument("video", type=str, help="The video file to ingest.")
+    parser.add_argument("dataset_name", type=str, help="The dataset folder inside ref_data/ (e.g., 'abuse').")
+    args = parser.parse_args()
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    output_path = os.path.join(os.path.dirname(script_dir), 'ref_data', args.dataset_name, STORE_NAME)
+    print(f"[INFO] Writing frames of '{args.video}' to {output_path}")
+    start_time = time.time()
+    if ingest_video(args.video, output_path):
+        print(f"[SUCCESS] Finished in {time.time() - start_time:.2f} seconds.")
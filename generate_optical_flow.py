@@ -2,68 +2,208 @@
 import cv2
 import os
 import numpy as np
-import scipy.io
 import glob
 import time
 import argparse # We use argparse to accept command-line arguments
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from flow_store import FlowStoreWriter, TiledFlowStoreWriter, STORE_NAME
+from flow_engines import ENGINES, make_engine
+from frame_store import FrameStore, open_frame_store
 
-def generate_for_dataset(dataset_name):
+def read_gray(path):
+    """Decodes one frame and converts it to grayscale (None if unreadable)."""
+    frame = cv2.imread(path)
+    if frame is None:
+        return None
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+def read_frame(image_paths, i):
+    """Grayscale frame i of a list of image files or of a FrameStore (None if unreadable)."""
+    if isinstance(image_paths, FrameStore):
+        return image_paths[i]
+    return read_gray(image_paths[i])
+
+def bounded_map(pool, fn, items, ahead, *args):
+    """
+    fn(item, *args) for every item on pool, in order, like pool.map but with
+    at most `ahead` calls pending beyond the result being consumed, so results
+    never pile up in memory faster than the caller uses them.
+    """
+    window = deque()
+    for item in items:
+        window.append(pool.submit(fn, item, *args))
+        if len(window) > ahead:
+            yield window.popleft().result()
+    while window:
+        yield window.popleft().result()
+
+def read_frames(image_paths, pool, prefetch=2):
+    """
+    The grayscale frames of image_paths in order (None where unreadable).
+    Image files are decoded on pool at most `prefetch` frames ahead of the
+    consumer, so a slow consumer never has the whole clip decoded in memory.
+    A FrameStore's frames are used as they are.
+    """
+    if isinstance(image_paths, FrameStore):
+        yield from image_paths
+        return
+    yield from bounded_map(pool, read_gray, image_paths, prefetch)
+
+def iter_flow_sequence(image_paths, prefetch=2, engine='farneback'):
+    """
+    Calculates flow between consecutive readable frames of image_paths with
+    engine (a flow_engines name or engine object; Farneback by default).
+    image_paths is a list of image files, decoded ahead of time by a small
+    thread pool (OpenCV releases the GIL while decoding) so I/O overlaps with
+    the flow computation, or a FrameStore whose grayscale frames are used as
+    they are. Yields one (u, v) pair per frame pair.
+    """
+    if isinstance(engine, str):
+        engine = make_engine(engine)
+    with ThreadPoolExecutor(max_workers=prefetch) as pool:
+        yield from _flow_pairs(read_frames(image_paths, pool, prefetch), engine)
+
+def _flow_pairs(frames, engine):
+    frame_prev_gray = None
+    for frame_next_gray in frames:
+        if frame_next_gray is None: continue
+        if frame_prev_gray is None:
+            frame_prev_gray = frame_next_gray
+            continue
+        flow = engine.compute(frame_prev_gray, frame_next_gray)
+        yield flow[..., 0], flow[..., 1]
+        frame_prev_gray = frame_next_gray
+
+def _flow_shard(image_paths, engine='farneback'):
+    """
+    Process-pool entry point: flow for one contiguous shard of frame pairs,
+    plus the per-frame regions of an ROI engine (None for dense engines) and
+    the (first, last) local indices of the shard's readable frames (None if
+    it has none), so the caller can bridge an unreadable boundary frame.
+    """
+    # Each process already owns a core, so keep OpenCV from spawning its own threads
+    cv2.setNumThreads(1)
+    engine = make_engine(engine)
+    u_frames = []
+    v_frames = []
+    regions = []
+    readable = []
+
+    def tracked(frames):
+        for i, frame in enumerate(frames):
+            if frame is not None:
+                readable.append(i)
+            yield frame
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        for u, v in _flow_pairs(tracked(read_frames(image_paths, pool)), engine):
+            u_frames.append(u)
+            v_frames.append(v)
+            regions.append(getattr(engine, 'last_regions', None))
+    span = (readable[0], readable[-1]) if readable else None
+    if not u_frames:
+        return None, None, None, span
+    return np.stack(u_frames, axis=-1), np.stack(v_frames, axis=-1), regions, span
+
+def open_writer(output_path, chunk_size, engine):
+    """A tiled store for ROI engines, which only compute flow around the foreground, else a dense one."""
+    if engine.startswith('roi-'):
+        return TiledFlowStoreWriter(output_path, chunk_size=chunk_size, engine=engine)
+    return FlowStoreWriter(output_path, chunk_size=chunk_size, engine=engine)
+
+def _append(writer, u, v, regions):
+    if isinstance(writer, TiledFlowStoreWriter):
+        writer.append(u, v, regions)
+    else:
+        writer.append(u, v)
+
+def shard_paths(image_paths, shard_size):
+    """
+    Splits the frame list (or FrameStore) into shards of shard_size frame pairs.
+    Neighbouring shards share their boundary frame so that no pair is lost;
+    if that frame is unreadable, generate_for_dataset bridges the gap.
+    """
+    shards = []
+    for start in range(0, len(image_paths) - 1, shard_size):
+        shards.append(image_paths[start:start + shard_size + 1])
+    return shards
+
+def generate_for_dataset(dataset_name, workers=1, shard_size=32, chunk_size=64, engine='farneback'):
     """
     Calculates dense optical flow for a specific dataset folder.
+    Frames are decoded a bounded number of frames (or shards) ahead and the
+    flow is appended to the chunked flow store as it is computed (see
+    flow_store.py), so neither side's memory grows with the length of the clip.
+    With workers > 1 the frame pairs are sharded over a process pool and the
+    u/v frames are appended in frame order. engine names the flow_engines
+    implementation, and is recorded in the store index. Frames come from the
+    dataset's frame store (see frame_store.py) when it has been ingested,
+    otherwise from the original_pics TIFFs.
     """
     script_dir = os.path.dirname(os.path.abspath(__file__))
     base_dir = os.path.dirname(script_dir)
     
     dataset_dir = os.path.join(base_dir, 'ref_data',  dataset_name)
     image_dir = os.path.join(dataset_dir, 'original_pics')
-    output_path = os.path.join(dataset_dir, 'optical_flow.mat') # Save directly in the dataset folder
+    output_path = os.path.join(dataset_dir, STORE_NAME) # Save directly in the dataset folder
     
-    if not os.path.isdir(image_dir):
-        print(f"[ERROR] Image directory not found: {image_dir}")
+    frames = open_frame_store(dataset_dir)
+    if frames is None and not os.path.isdir(image_dir):
+        print(f"[ERROR] Neither a frame store nor an image directory found in: {dataset_dir}")
         return
 
     print(f"\n--- Processing Dataset: {dataset_name} ---")
-    print(f"[INFO] Image source: {image_dir}")
+    print(f"[INFO] Image source: {image_dir if frames is None else frames.path}")
     print(f"[INFO] Output file: {output_path}")
+    print(f"[INFO] Flow engine: {engine}")
 
-    image_paths = sorted(glob.glob(os.path.join(image_dir, '*.tif')))
+    if frames is None:
+        frames = sorted(glob.glob(os.path.join(image_dir, '*.tif')))
     
-    num_frames = len(image_paths)
+    num_frames = len(frames)
     if num_frames < 2:
         print("[ERROR] Need at least 2 images.")
         return
         
-    print(f"[INFO] Found {num_frames} images.")
+    print(f"[INFO] Found {num_frames} frames.")
 
-    frame_prev = cv2.imread(image_paths[0])
-    frame_prev_gray = cv2.cvtColor(frame_prev, cv2.COLOR_BGR2GRAY)
-    
-    u_frames = []
-    v_frames = []
     start_time = time.time()
-    
-    for i in range(1, num_frames):
-        print(f"\r[INFO] Calculating flow for frame {i}/{num_frames - 1}...", end="", flush=True)
-        
-        frame_next = cv2.imread(image_paths[i])
-        if frame_next is None: continue
-        frame_next_gray = cv2.cvtColor(frame_next, cv2.COLOR_BGR2GRAY)
-        
-        flow = cv2.calcOpticalFlowFarneback(frame_prev_gray, frame_next_gray, None, 0.5, 3, 15, 3, 5, 1.2, 0)
-        
-        u_frames.append(flow[..., 0])
-        v_frames.append(flow[..., 1])
-        frame_prev_gray = frame_next_gray
-        
-    print("\n[INFO] Optical flow calculation complete.")
-    
-    u_stack = np.stack(u_frames, axis=-1)
-    v_stack = np.stack(v_frames, axis=-1)
-    
-    print(f"[INFO] Final data shape: {u_stack.shape}")
-    
-    print(f"[INFO] Saving combined flow to {output_path}...")
-    scipy.io.savemat(output_path, {'u_flow': u_stack, 'v_flow': v_stack})
+
+    with open_writer(output_path, chunk_size, engine) as writer:
+        if workers > 1:
+            shards = shard_paths(frames, shard_size)
+            print(f"[INFO] Calculating flow for {num_frames - 1} frame pairs in {len(shards)} shards on {workers} workers...")
+            bridge_engine = make_engine(engine)
+            prev_last = None    # global index of the last readable frame so far
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                # Shards come back in frame order, at most two per worker in flight
+                results = bounded_map(pool, _flow_shard, shards, 2 * workers, engine)
+                for done, (u_part, v_part, regions, span) in enumerate(results, start=1):
+                    print(f"\r[INFO] Finished shard {done}/{len(shards)}...", end="", flush=True)
+                    if span is None: continue
+                    first = (done - 1) * shard_size + span[0]
+                    if prev_last is not None and first != prev_last:
+                        # The shared boundary frame was unreadable; the serial path pairs across the gap
+                        bridge_engine.reset()
+                        flow = bridge_engine.compute(read_frame(frames, prev_last), read_frame(frames, first))
+                        _append(writer, flow[..., 0], flow[..., 1], getattr(bridge_engine, 'last_regions', None))
+                    prev_last = (done - 1) * shard_size + span[1]
+                    if u_part is None: continue
+                    for k in range(u_part.shape[2]):
+                        _append(writer, u_part[:, :, k], v_part[:, :, k], regions[k])
+        else:
+            flow_engine = make_engine(engine)
+            for i, (u, v) in enumerate(iter_flow_sequence(frames, engine=flow_engine), start=1):
+                print(f"\r[INFO] Calculating flow for frame {i}/{num_frames - 1}...", end="", flush=True)
+                _append(writer, u, v, getattr(flow_engine, 'last_regions', None))
+        print("\n[INFO] Optical flow calculation complete.")
+
+    print(f"[INFO] Final data shape: {(writer.height, writer.width, writer.num_frames)}")
+    print(f"[INFO] Saved {len(writer.chunks)} flow chunks to {output_path}")
+    if isinstance(writer, TiledFlowStoreWriter):
+        total_tiles = writer.num_frames * -(-writer.height // writer.tile_size) * -(-writer.width // writer.tile_size)
+        print(f"[INFO] Stored {writer.stored_tiles} of {total_tiles} flow tiles ({writer.stored_tiles / max(total_tiles, 1):.1%}).")
     
     end_time = time.time()
     print(f"[SUCCESS] Finished in {end_time - start_time:.2f} seconds.")
@@ -72,6 +212,11 @@ if __name__ == '__main__':
     # --- This part allows you to specify the folder from the command line ---
     parser = argparse.ArgumentParser(description="Generate optical flow for a dataset.")
     parser.add_argument("dataset_name", type=str, help="The name of the dataset folder inside ref_data/datasets/ (e.g., 'video1_church')")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes used to compute flow (default: 1).")
+    parser.add_argument("--shard-size", type=int, default=32, help="Frame pairs handed to a worker at a time (default: 32).")
+    parser.add_argument("--chunk-size", type=int, default=64, help="Flow frames per chunk file in the store (default: 64).")
+    parser.add_argument("--engine", choices=ENGINES, default='farneback', help="Optical flow implementation (default: farneback).")
     args = parser.parse_args()
     
-    generate_for_dataset(args.dataset_name)
\ No newline at end of file
+    generate_for_dataset(args.dataset_name, workers=args.workers, shard_size=args.shard_size,
+                         chunk_size=args.chunk_size, engine=args.engine)
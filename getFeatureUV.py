@@ -7,45 +7,99 @@ from split import *
 # This font variable is from the test function, can be removed if not needed elsewhere
 font=cv2.FONT_HERSHEY_COMPLEX
 
-def getFeaturesUV(realPos, u, v):
+def integral_image(img, out=None):
+    """
+    Summed-area table of img with a leading zero row and column, in float64,
+    so the sum of img[y0:y1, x0:x1] is S[y1,x1] - S[y0,x1] - S[y1,x0] + S[y0,x0].
+    Pass a reusable (h+1, w+1) float64 array as out to avoid allocating one per frame.
+    """
+    if out is None:
+        S = np.zeros((img.shape[0] + 1, img.shape[1] + 1), dtype=np.float64)
+    else:
+        S = out
+        S[0, :] = 0
+        S[:, 0] = 0
+    np.cumsum(img, axis=0, dtype=np.float64, out=S[1:, 1:])
+    np.cumsum(S[1:, 1:], axis=1, out=S[1:, 1:])
+    return S
+
+def box_sums(S, y_start, y_end, x_start, x_end):
+    """Sums of every box at once from a summed-area table (one gather per corner)."""
+    return S[y_end, x_end] - S[y_start, x_end] - S[y_end, x_start] + S[y_start, x_start]
+
+def box_bounds(realPos, shape):
+    """
+    Integer slice bounds of every box, clipped to the frame like a slice would be.
+    Degenerate boxes are widened to one pixel in place, as the per-box loop used to do.
+    """
+    bad = realPos[:, 0] <= realPos[:, 1]
+    realPos[bad, 0] = realPos[bad, 1] + 1
+    bad = realPos[:, 2] <= realPos[:, 3]
+    realPos[bad, 2] = realPos[bad, 3] + 1
+
+    y_start = np.clip(realPos[:, 1].astype(np.int64), 0, shape[0])
+    y_end = np.clip(realPos[:, 0].astype(np.int64), 0, shape[0])
+    x_start = np.clip(realPos[:, 3].astype(np.int64), 0, shape[1])
+    x_end = np.clip(realPos[:, 2].astype(np.int64), 0, shape[1])
+    y_end = np.maximum(y_end, y_start)
+    x_end = np.maximum(x_end, x_start)
+    return y_start, y_end, x_start, x_end
+
+def workspace_buffer(workspace, name, shape, dtype=np.float64):
+    """Returns the named scratch array from workspace (a dict), allocating it on first use."""
+    if workspace is None:
+        return None
+    buf = workspace.get(name)
+    if buf is None or buf.shape != shape or buf.dtype != dtype:
+        buf = np.empty(shape, dtype=dtype)
+        workspace[name] = buf
+    return buf
+
+def getFeaturesUV(realPos, u, v, extended=False, bins=8, workspace=None):
     """
     Calculates optical flow features (u, v) for each bounding box in realPos.
-    Includes a safety check to prevent warnings and NaN values from empty slices.
+    Every box mean comes from one summed-area table of u and of v, so the cost
+    per box is constant. Empty boxes get 0 instead of NaN.
+
+    With extended=True the columns are followed by the mean flow magnitude,
+    the variances of u and v and a `bins`-bin orientation histogram (fraction
+    of the box's pixels per direction), all read from integral images built
+    once per frame.
+
+    workspace is an optional dict kept by the caller across frames; the
+    integral images are then built into the same buffers every frame.
     """
     # First, check if there are any positions to process at all.
     if realPos.size == 0:
-        return np.zeros((0, 2))
-
-    n = realPos.shape[0]
-    data = np.zeros((n, 2))
-    for i in range(n):
-        # Ensure bounding box coordinates can form a valid slice.
-        if realPos[i][0] <= realPos[i][1]:
-            realPos[i][0] = realPos[i][1] + 1
-        if realPos[i][2] <= realPos[i][3]:
-            realPos[i][2] = realPos[i][3] + 1
-        
-        # Define the y and x ranges for the slice
-        y_start, y_end = int(realPos[i][1]), int(realPos[i][0])
-        x_start, x_end = int(realPos[i][3]), int(realPos[i][2])
-
-        # ==========================================================
-        # --- THIS IS THE FIX ---
-        # 1. Extract the Region of Interest (ROI) from the u and v flow fields.
-        u_roi = u[y_start:y_end, x_start:x_end]
-        v_roi = v[y_start:y_end, x_start:x_end]
-
-        # 2. Check if the resulting slice (ROI) is empty.
-        if u_roi.size == 0:
-            # 3. If it's empty, assign 0 to prevent a RuntimeWarning and NaN.
-            data[i][0] = 0
-            data[i][1] = 0
-        else:
-            # 4. If it's not empty, calculate the mean as normal.
-            data[i][0] = u_roi.mean()
-            data[i][1] = v_roi.mean()
-        # ==========================================================
-            
+        return np.zeros((0, 2 + (3 + bins if extended else 0)))
+
+    y_start, y_end, x_start, x_end = box_bounds(realPos, u.shape)
+    area = (y_end - y_start) * (x_end - x_start)
+    # Empty boxes divide by 1 and keep their zero sums
+    divisor = np.where(area > 0, area, 1)
+
+    sat_shape = (u.shape[0] + 1, u.shape[1] + 1)
+    S_u = integral_image(u, out=workspace_buffer(workspace, 'sat_u', sat_shape))
+    S_v = integral_image(v, out=workspace_buffer(workspace, 'sat_v', sat_shape))
+    columns = [box_sums(S_u, y_start, y_end, x_start, x_end) / divisor,
+               box_sums(S_v, y_start, y_end, x_start, x_end) / divisor]
+
+    if extended:
+        mean_u, mean_v = columns
+        magnitude = np.sqrt(np.square(u, dtype=np.float64) + np.square(v, dtype=np.float64))
+        columns.append(box_sums(integral_image(magnitude), y_start, y_end, x_start, x_end) / divisor)
+        for component, mean in ((u, mean_u), (v, mean_v)):
+            mean_sq = box_sums(integral_image(np.square(component, dtype=np.float64)),
+                               y_start, y_end, x_start, x_end) / divisor
+            columns.append(np.maximum(mean_sq - mean * mean, 0))
+
+        angle = np.arctan2(v, u)
+        bin_index = np.minimum(((angle + np.pi) / (2 * np.pi) * bins).astype(np.int64), bins - 1)
+        for b in range(bins):
+            columns.append(box_sums(integral_image(bin_index == b), y_start, y_end, x_start, x_end) / divisor)
+
+    data = np.stack(columns, axis=1)
+    data[area == 0] = 0
     return data
 
 def main_test():
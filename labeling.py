@@ -1,15 +1,21 @@
 import numpy as np
 import cv2
 
-def labeling(pos, abnormal_fg_img, gate=0.5):
+def labeling(pos, abnormal_fg_img, gate=0.5, return_overlap=False):
     """
     Labels bounding boxes as normal (0) or abnormal (1).
     This version includes a robust thresholding step to ensure masks are
     interpreted correctly as pure black and white.
+    All box means come from one integral image of the thresholded mask.
+    With return_overlap=True the fraction of each box covered by the abnormal
+    mask is returned as a third value, for soft labels.
     """
     if abnormal_fg_img is None:
         # If no mask file exists for a frame, all labels are 0.
-        return pos, np.zeros(pos.shape[0], dtype=int)
+        labels = np.zeros(pos.shape[0], dtype=int)
+        if return_overlap:
+            return pos, labels, np.zeros(pos.shape[0])
+        return pos, labels
 
     # --- THIS IS THE FINAL, DEFINITIVE FIX ---
     # 1. Convert to grayscale to handle any format (like RGBA).
@@ -23,20 +29,26 @@ def labeling(pos, abnormal_fg_img, gate=0.5):
     _ , thresh_mask = cv2.threshold(abnormal_fg_img, 10, 255, cv2.THRESH_BINARY)
     # --- END FIX ---
 
-    labels = []
     # Now, we use the clean, thresholded mask for all calculations.
-    for thePos in pos:
-        y_start, y_end = int(thePos[1]), int(thePos[0])
-        x_start, x_end = int(thePos[3]), int(thePos[2])
-        
-        # Get the region of interest from the CLEAN mask
-        roi = thresh_mask[y_start:y_end, x_start:x_end]
-        
-        # The 'gate' is now redundant because our mask is either 0 or 255,
-        # but we keep the logic. If any white pixel exists, the mean will be > 0.5.
-        if roi.size > 0 and roi.mean() > gate:
-            labels.append(1)  # Abnormal
-        else:
-            labels.append(0)  # Normal
+    # Sums over any box are four lookups in the integral image (exact in float64).
+    integral = cv2.integral(thresh_mask, sdepth=cv2.CV_64F)
+    height, width = thresh_mask.shape
+    pos_int = pos.astype(np.int64).reshape((-1, 5))
+    y_start = np.clip(pos_int[:, 1], 0, height)
+    y_end = np.clip(pos_int[:, 0], 0, height)
+    x_start = np.clip(pos_int[:, 3], 0, width)
+    x_end = np.clip(pos_int[:, 2], 0, width)
+    size = np.maximum(y_end - y_start, 0) * np.maximum(x_end - x_start, 0)
 
-    return pos, np.array(labels)
\ No newline at end of file
+    y_end = np.maximum(y_end, y_start)
+    x_end = np.maximum(x_end, x_start)
+    sums = integral[y_end, x_end] - integral[y_start, x_end] - integral[y_end, x_start] + integral[y_start, x_start]
+    means = sums / np.where(size > 0, size, 1)
+
+    # The 'gate' is now redundant because our mask is either 0 or 255,
+    # but we keep the logic. If any white pixel exists, the mean will be > 0.5.
+    labels = ((size > 0) & (means > gate)).astype(int) # 1 = Abnormal, 0 = Normal
+
+    if return_overlap:
+        return pos, labels, means / 255.0
+    return pos, labels
@@ -1,37 +1,234 @@
+# main_detect.py
 import cv2
-import joblib
-from Feature_extraction import extract_features
+import os
+import time
+import argparse
+import numpy as np
 
-# Load model
-model = joblib.load("svm_model.pkl")  # Change to knn_model.pkl or logreg_model.pkl if needed
+from weight_matrix import Weight_matrix
+from split import Spliter
+from getFeatureUV import getFeaturesUV, workspace_buffer
+from poscal import poscal
+from model_store import load_model
+from flow_engines import ENGINES, FarnebackEngine, make_engine
+from motion_gate import MotionGate
+from predict_service import PredictClient, load_authkey, parse_address
+from pipeline import detector_pipeline, frames_of
+from scaling import resize, scale_weight, to_native
 
-video_path = "test_video.mp4"
-cap = cv2.VideoCapture(video_path)
 
-while cap.isOpened():
-    ret, frame = cap.read()
-    if not ret:
-        break
+class StreamDetector(object):
+    """
+    Headless real-time detector. Runs the same chain as training
+    (poscal -> Spliter.split -> getFeaturesUV -> predict) directly on decoded
+    frames, keeping the previous grayscale frame and flow field in memory
+    instead of going through TIFFs, masks and optical_flow.mat on disk.
+    With scale < 1.0 frames are downscaled right after decoding, so the gate,
+    flow, blobs and features all run on the smaller frame; the flow is
+    brought back to native pixels per frame before weighting and boxes are
+    reported in native coordinates. Engines that find blobs themselves must
+    be made for the same scale, e.g. make_engine(name, scale).
+    """
 
-    features, bbox = extract_features(frame)
+    def __init__(self, model, weight, spliter=None, engine=None, gate=None, scale=1.0):
+        self.model = model
+        self.engine = engine if engine is not None else FarnebackEngine()
+        self.gate = gate
+        self.scale = scale
+        self.weigh = scale_weight(weight, scale)
+        self.sqrt_weigh = (np.sqrt(self.weigh) / scale).reshape((-1, 1))
+        self._workspace = {}
+        self.spliter = spliter if spliter is not None else Spliter(scale=scale)
 
-    if features is not None and bbox is not None:
-        prediction = model.predict([features])[0]
-        x, y, w, h = bbox
+        self.prev_gray = None
+        self.prev_timestamp = None
+        self.prev_flow = None
+        self.frame_index = -1
 
-        if prediction == 1:
-            color = (0, 0, 255)
-            label = "Abnormal"
+    def reset(self):
+        """Forgets the previous frame, e.g. after a seek or a dropped stream."""
+        self.engine.reset()
+        if self.gate is not None:
+            self.gate.reset()
+        self.prev_gray = None
+        self.prev_timestamp = None
+        self.prev_flow = None
+        self.frame_index = -1
+
+    def process(self, frame, timestamp):
+        """
+        Feeds one BGR frame. Returns (frame_index, timestamp, verdicts) for the
+        previous frame, or None while the first frame is being buffered or
+        when the motion gate skips the frame.
+        As in training, flow i goes from frame i to frame i+1 and the boxes
+        come from frame i, so verdicts always refer to the previous frame.
+        """
+        step = self.flow_step(frame, timestamp)
+        if step is None:
+            return None
+        frame_index, prev_timestamp, prev_gray, flow = step
+        positions, features = self.frame_features(prev_gray, flow, self._workspace)
+        return frame_index, prev_timestamp, self.classify(positions, features)
+
+    def flow_step(self, frame, timestamp):
+        """
+        The sequential part of process(): converts the frame to grayscale and
+        computes the flow from the previous one. Returns (frame_index,
+        timestamp, gray, flow) of the previous frame, or None on the first
+        and on frames the motion gate skips.
+        """
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim > 2 else frame
+        gray = resize(gray, self.scale)
+
+        if self.prev_gray is None:
+            self.prev_gray = gray
+            self.prev_timestamp = timestamp
+            self.frame_index = 0
+            return None
+
+        if self.gate is not None and not self.gate.check(self.prev_gray, gray):
+            # Keep following the frames so the next flow is still between neighbours;
+            # a warm-started engine's field is stale after a gap
+            self.engine.reset()
+            self.prev_flow = None
+            result = None
         else:
-            color = (0, 255, 0)
-            label = "Normal"
+            flow = self.engine.compute(self.prev_gray, gray)
+            self.prev_flow = flow
+            result = (self.frame_index, self.prev_timestamp, self.prev_gray, flow)
+
+        self.prev_gray = gray
+        self.prev_timestamp = timestamp
+        self.frame_index += 1
+        return result
+
+    def frame_features(self, gray, flow, workspace):
+        """
+        Boxes and features of one frame, given its grayscale image and the flow
+        to the next frame. Scratch arrays live in workspace (a dict), so
+        threads working on different frames must pass different workspaces.
+        """
+        # The foreground pictures used in training are the grayscale frames (see fg_pics.py)
+        initial_positions, mopho_img = poscal(gray, self.scale)
+        positions = self.spliter.split(initial_positions, mopho_img, self.weigh)
+        if positions.size == 0:
+            return positions, np.zeros((0, 2))
+
+        dtype = np.result_type(flow.dtype, self.sqrt_weigh.dtype)
+        u_weighted = workspace_buffer(workspace, 'u_weighted', gray.shape, dtype)
+        v_weighted = workspace_buffer(workspace, 'v_weighted', gray.shape, dtype)
+        np.multiply(flow[..., 0], self.sqrt_weigh, out=u_weighted)
+        np.multiply(flow[..., 1], self.sqrt_weigh, out=v_weighted)
+        features = np.nan_to_num(getFeaturesUV(positions, u_weighted, v_weighted, workspace=workspace))
+        return positions, features
+
+    def classify(self, positions, features):
+        """One predict call for every box in the frame; returns the verdict dicts."""
+        verdicts = []
+        if features.size > 0:
+            predictions = self.model.predict(features)
+            positions = to_native(positions, self.scale)
+            for box, prediction in zip(positions, predictions):
+                verdicts.append({
+                    'box': (int(box[3]), int(box[1]), int(box[2] - box[3]), int(box[0] - box[1])),
+                    'label': int(prediction),
+                })
+        return verdicts
+
+    def run(self, cap):
+        """Generator over a cv2.VideoCapture, yielding the result of every processed frame."""
+        while cap.isOpened():
+            ret, frame = cap.read()
+            if not ret:
+                break
+
+            result = self.process(frame, cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0)
+            if result is not None:
+                yield result
+
+
+def open_source(source):
+    """Opens a video file, stream URL or camera index (given as a digit string)."""
+    return cv2.VideoCapture(int(source) if source.isdigit() else source)
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    base_dir = os.path.dirname(script_dir)
+
+    parser = argparse.ArgumentParser(description="Run headless abnormal behaviour detection on a video stream.")
+    parser.add_argument("source", type=str, help="Video file, stream URL or camera index.")
+    parser.add_argument("--model", type=str, default=os.path.join(base_dir, 'models', 'svm_model'),
+                        help="Exported model directory (svm_model, logreg_model, knn_model) or a joblib .pkl.")
+    parser.add_argument("--ref-data", type=str, default=os.path.join(base_dir, 'ref_data'),
+                        help="The 'ref_data' directory holding poi.xml and connectedFieldImg.txt.")
+    parser.add_argument("--service", type=str, default=None,
+                        help="host:port of a running predict_service.py sharing one model between streams, instead of --model. "
+                             "Every frame costs a socket round trip; batching helps sklearn and KNN models, not exported SVM/linear ones.")
+    parser.add_argument("--authkey-file", type=str, default=None,
+                        help="With --service, the service's key file (default: as predict_service.py).")
+    parser.add_argument("--engine", choices=ENGINES, default='farneback',
+                        help="Optical flow implementation; use the one the model was trained on (default: farneback).")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="Process frames at this fraction of their resolution, e.g. 0.5; boxes stay in native pixels (default: 1.0).")
+    parser.add_argument("--motion-gate", action="store_true",
+                        help="Skip flow and classification on static frames, processing one in --idle-every.")
+    parser.add_argument("--motion-threshold", type=float, default=0.002,
+                        help="Fraction of changed pixels that counts as motion (default: 0.002).")
+    parser.add_argument("--idle-every", type=int, default=10, help="With --motion-gate, frames per processed static frame (default: 10).")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Overlap capture, flow, features and classification in separate threads.")
+    parser.add_argument("--feature-workers", type=int, default=2, help="Feature threads with --pipeline (default: 2).")
+    parser.add_argument("--queue-size", type=int, default=4, help="Frames each --pipeline stage may queue (default: 4).")
+    parser.add_argument("--drop-oldest", action="store_true",
+                        help="With --pipeline, drop the oldest frame waiting for features or classification instead of "
+                             "slowing the flow stage down; flow itself still sees every frame.")
+    parser.add_argument("--metrics-every", type=float, default=None,
+                        help="With --pipeline, print queue depths and stage latencies every N seconds.")
+    args = parser.parse_args()
+
+    cap = open_source(args.source)
+    if not cap.isOpened():
+        print(f"[ERROR] Could not open video source '{args.source}'")
+        return
+
+    frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    weight = Weight_matrix(ref_data_path=args.ref_data, frame_height=frame_height).get_weight_matrix()
+    if args.service:
+        model = PredictClient(args.source, parse_address(args.service), load_authkey(args.authkey_file))
+    else:
+        model = load_model(args.model)
+    gate = MotionGate(threshold=args.motion_threshold, idle_every=args.idle_every) if args.motion_gate else None
+    detector = StreamDetector(model, weight, engine=make_engine(args.engine, args.scale), gate=gate, scale=args.scale)
+
+    start_time = time.time()
+    processed = 0
+
+    def emit(result):
+        nonlocal processed
+        frame_index, timestamp, verdicts = result
+        processed += 1
+        for verdict in verdicts:
+            x, y, w, h = verdict['box']
+            label = "Abnormal" if verdict['label'] == 1 else "Normal"
+            print(f"{timestamp:.3f}\t{frame_index}\t{x}\t{y}\t{w}\t{h}\t{label}", flush=True)
+
+    if args.pipeline:
+        pipeline = detector_pipeline(detector, frames_of(cap), emit, feature_workers=args.feature_workers,
+                                     maxsize=args.queue_size, drop_oldest=args.drop_oldest)
+        pipeline.run_sync(report_every=args.metrics_every)
+        pipeline.report()
+    else:
+        for result in detector.run(cap):
+            emit(result)
 
-        cv2.rectangle(frame, (x, y), (x + w, y + h), color, 2)
-        cv2.putText(frame, label, (x, y - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
+    cap.release()
+    elapsed = time.time() - start_time
+    if processed:
+        print(f"[INFO] Processed {processed} frames at {processed / elapsed:.1f} fps.")
+    if gate is not None:
+        print(f"[INFO] Motion gate skipped {gate.skipped} of {gate.frames} frames (skip ratio {gate.skip_ratio:.2f}).")
 
-    cv2.imshow("Abnormal Behavior Detection", frame)
-    if cv2.waitKey(30) & 0xFF == 27:
-        break
 
-cap.release()
-cv2.destroyAllWindows()
+if __name__ == '__main__':
+    main()
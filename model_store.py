@@ -0,0 +1,231 @@
+# model_store.py
+import os
+import json
+import joblib
+import numpy as np
+
+MANIFEST_NAME = 'manifest.json'
+
+def _save_arrays(directory, manifest, arrays):
+    """Writes each array as <name>.npy next to a JSON manifest."""
+    os.makedirs(directory, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, name + '.npy'), array)
+    manifest = dict(manifest, arrays=sorted(arrays))
+    tmp_path = os.path.join(directory, MANIFEST_NAME + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(directory, MANIFEST_NAME))
+
+def _load_arrays(directory, manifest, mmap=True):
+    mode = 'r' if mmap else None
+    return {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode=mode) for name in manifest['arrays']}
+
+def export_knn(model, directory, train_data, train_labels):
+    """
+    Saves a fitted KNeighborsClassifier as its training points (float32) and
+    their labels encoded as indices into classes_ (int32), so that CompactKNN
+    can load it without unpickling the training set. train_data and
+    train_labels must be the arrays the model was fitted on.
+    """
+    if model.effective_metric_ != 'euclidean':
+        raise ValueError(f"Only the euclidean metric is supported, not {model.effective_metric_!r}")
+
+    X = np.asarray(train_data, dtype=np.float32)
+    train_labels = np.asarray(train_labels)
+    classes = np.asarray(model.classes_)
+    if X.shape != (model.n_samples_fit_, model.n_features_in_) or not np.isin(train_labels, classes).all():
+        raise ValueError("train_data and train_labels are not the data the KNN model was fitted on")
+    y = np.searchsorted(classes, train_labels)
+
+    manifest = {
+        'type': 'knn',
+        'n_neighbors': int(model.n_neighbors),
+        'weights': model.weights,
+        'classes': classes.tolist(),
+    }
+    _save_arrays(directory, manifest, {'points': X, 'labels': y.astype(np.int32)})
+
+class CompactKNN(object):
+    """
+    KNN classifier over an export_knn directory. The points are memory-mapped
+    and indexed once at load by a sklearn KDTree, which answers the queries.
+    """
+
+    def __init__(self, manifest, arrays):
+        # Only the KNN loader needs sklearn; the other loaders run on numpy alone
+        from sklearn.neighbors import KDTree
+
+        self.n_neighbors = manifest['n_neighbors']
+        self.weights = manifest['weights']
+        self.classes_ = np.asarray(manifest['classes'])
+        self.points = arrays['points']
+        self.labels = arrays['labels']
+        self.tree = KDTree(self.points)
+
+    def kneighbors(self, X):
+        """Distances and indices of the k nearest points to every row of X, nearest first."""
+        k = min(self.n_neighbors, self.points.shape[0])
+        return self.tree.query(np.asarray(X, dtype=np.float64), k=k)
+
+    def predict(self, X):
+        X = np.asarray(X)
+        if X.shape[0] == 0:
+            return self.classes_[:0]
+        dist, ind = self.kneighbors(X)
+        neighbour_labels = self.labels[ind]
+
+        if self.weights == 'distance':
+            with np.errstate(divide='ignore'):
+                w = 1.0 / dist
+            # Exact matches take all the weight, as in sklearn
+            exact = np.isinf(w)
+            w = np.where(exact.any(axis=1, keepdims=True), exact.astype(float), w)
+        else:
+            w = np.ones_like(dist)
+
+        votes = np.zeros((X.shape[0], self.classes_.size))
+        np.add.at(votes, (np.arange(X.shape[0])[:, None], neighbour_labels), w)
+        # argmax takes the first (smallest) class on ties, like sklearn's mode
+        return self.classes_[np.argmax(votes, axis=1)]
+
+def svm_gamma(model, train_data=None):
+    """
+    The numeric gamma an SVC was trained with. 'scale' depends on the
+    training data, 1 / (n_features * X.var()), so it needs train_data.
+    """
+    if model.gamma == 'auto':
+        return 1.0 / model.n_features_in_
+    if model.gamma == 'scale':
+        if train_data is None:
+            raise ValueError("Resolving gamma='scale' needs the train_data the SVC was fitted on")
+        variance = np.asarray(train_data, dtype=np.float64).var()
+        return 1.0 / (model.n_features_in_ * variance) if variance != 0 else 1.0
+    return float(model.gamma)
+
+def export_svm(model, directory, train_data=None):
+    """
+    Saves a fitted binary SVC (rbf or linear kernel) as its support vectors,
+    their squared norms, dual coefficients, intercept and resolved gamma, for
+    CompactSVM. train_data is needed for an rbf kernel with gamma='scale'.
+    """
+    if len(model.classes_) != 2:
+        raise ValueError(f"Only binary SVC models are supported, not {len(model.classes_)} classes")
+    if model.kernel not in ('rbf', 'linear'):
+        raise ValueError(f"Only the rbf and linear kernels are supported, not {model.kernel!r}")
+
+    support_vectors = np.asarray(model.support_vectors_, dtype=np.float64)
+    manifest = {
+        'type': 'svm',
+        'kernel': model.kernel,
+        'gamma': svm_gamma(model, train_data) if model.kernel == 'rbf' else None,
+        'classes': np.asarray(model.classes_).tolist(),
+    }
+    _save_arrays(directory, manifest, {
+        'support_vectors': support_vectors,
+        'sv_norms': np.einsum('nd,nd->n', support_vectors, support_vectors),
+        'dual_coef': np.asarray(model.dual_coef_[0], dtype=np.float64),
+        'intercept': np.asarray(model.intercept_, dtype=np.float64),
+    })
+
+def export_linear(model, directory):
+    """Saves a fitted linear classifier (LogisticRegression, SGDClassifier) as coef_ and intercept_."""
+    manifest = {
+        'type': 'linear',
+        'classes': np.asarray(model.classes_).tolist(),
+    }
+    _save_arrays(directory, manifest, {
+        'coef': np.asarray(model.coef_, dtype=np.float64),
+        'intercept': np.asarray(model.intercept_, dtype=np.float64),
+    })
+
+def export_model(model, directory, train_data=None, train_labels=None):
+    """
+    Exports any of the project's classifiers in the array format read by
+    load_model. A KNN model is its training set, so train_data and
+    train_labels are required for one; an SVC with gamma='scale' needs
+    train_data to resolve its gamma.
+    """
+    # Only exporting needs sklearn; the SVM and linear loaders run on numpy alone
+    from sklearn.svm import SVC
+    from sklearn.neighbors import KNeighborsClassifier
+
+    if isinstance(model, KNeighborsClassifier):
+        if train_data is None or train_labels is None:
+            raise ValueError("Exporting a KNN model needs the train_data and train_labels it was fitted on")
+        export_knn(model, directory, train_data, train_labels)
+    elif isinstance(model, SVC):
+        export_svm(model, directory, train_data)
+    elif hasattr(model, 'coef_') and hasattr(model, 'intercept_'):
+        export_linear(model, directory)
+    else:
+        raise ValueError(f"No array export for {type(model).__name__}")
+
+class CompactSVM(object):
+    """Binary kernel SVM over an export_svm directory: decision = dual_coef . K(sv, x) + intercept."""
+
+    def __init__(self, manifest, arrays):
+        self.kernel = manifest['kernel']
+        self.gamma = manifest['gamma']
+        self.classes_ = np.asarray(manifest['classes'])
+        self.support_vectors = arrays['support_vectors']
+        self.sv_norms = arrays['sv_norms']
+        self.dual_coef = arrays['dual_coef']
+        self.intercept = float(arrays['intercept'][0])
+
+    def decision_function(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        K = X @ self.support_vectors.T
+        if self.kernel == 'rbf':
+            # exp(-gamma * |x - sv|^2), with |x - sv|^2 expanded so K is the only (q, n_sv) array
+            K *= 2
+            K -= self.sv_norms
+            K -= np.einsum('qd,qd->q', X, X)[:, None]
+            np.minimum(K, 0, out=K)
+            K *= self.gamma
+            np.exp(K, out=K)
+        return K @ self.dual_coef + self.intercept
+
+    def predict(self, X):
+        X = np.asarray(X)
+        if X.shape[0] == 0:
+            return self.classes_[:0]
+        return self.classes_[(self.decision_function(X) > 0).astype(int)]
+
+class CompactLinear(object):
+    """Linear classifier over an export_linear directory."""
+
+    def __init__(self, manifest, arrays):
+        self.classes_ = np.asarray(manifest['classes'])
+        self.coef = arrays['coef']
+        self.intercept = arrays['intercept']
+
+    def decision_function(self, X):
+        scores = np.asarray(X, dtype=np.float64) @ self.coef.T + self.intercept
+        return scores[:, 0] if scores.shape[1] == 1 else scores
+
+    def predict(self, X):
+        X = np.asarray(X)
+        if X.shape[0] == 0:
+            return self.classes_[:0]
+        scores = self.decision_function(X)
+        if scores.ndim == 1:
+            return self.classes_[(scores > 0).astype(int)]
+        return self.classes_[np.argmax(scores, axis=1)]
+
+_LOADERS = {'knn': CompactKNN, 'svm': CompactSVM, 'linear': CompactLinear}
+
+def load_model(path, mmap=True):
+    """
+    Loads a model for prediction: an exported array directory (with a
+    manifest.json) through its memory-mapped loader, anything else with joblib.
+    """
+    manifest_path = os.path.join(path, MANIFEST_NAME)
+    if os.path.isdir(path) and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        arrays = _load_arrays(path, manifest, mmap=mmap)
+        if manifest['type'] in _LOADERS:
+            return _LOADERS[manifest['type']](manifest, arrays)
+        raise ValueError(f"Unknown model type {manifest['type']!r} in {manifest_path}")
+    return joblib.load(path)
@@ -0,0 +1,58 @@
+# motion_gate.py
+import cv2
+import numpy as np
+
+class MotionGate(object):
+    """
+    Cheap activity test run before the optical flow. Motion energy is the
+    fraction of pixels (on a frame subsampled by `scale`) whose grey level
+    changed by more than pixel_threshold since the previous frame. A frame
+    at or above `threshold` is active and is processed, as are the `hold`
+    frames after the last active one. Quiet frames are only processed every
+    idle_every-th frame, so the expensive stages drop to a trickle on a
+    static scene and return to full rate on the first active frame.
+    """
+
+    def __init__(self, threshold=0.002, pixel_threshold=15, idle_every=10, hold=25, scale=4):
+        self.threshold = threshold
+        self.pixel_threshold = pixel_threshold
+        self.idle_every = idle_every
+        self.hold = hold
+        self.scale = scale
+
+        self.frames = 0
+        self.skipped = 0
+        self.energy = 0.0
+        self._since_active = None
+        self._since_processed = 0
+
+    def motion_energy(self, prev_gray, gray):
+        s = self.scale
+        diff = cv2.absdiff(prev_gray[::s, ::s], gray[::s, ::s])
+        return np.count_nonzero(diff > self.pixel_threshold) / diff.size
+
+    def check(self, prev_gray, gray):
+        """True if the frame pair (prev_gray, gray) should go through the full pipeline."""
+        self.frames += 1
+        self.energy = self.motion_energy(prev_gray, gray)
+        if self.energy >= self.threshold:
+            self._since_active = 0
+        elif self._since_active is not None:
+            self._since_active += 1
+
+        active = self._since_active is not None and self._since_active <= self.hold
+        if active or self._since_processed + 1 >= self.idle_every:
+            self._since_processed = 0
+            return True
+        self._since_processed += 1
+        self.skipped += 1
+        return False
+
+    @property
+    def skip_ratio(self):
+        return self.skipped / self.frames if self.frames else 0.0
+
+    def reset(self):
+        """Forgets the activity history (the counters are kept)."""
+        self._since_active = None
+        self._since_processed = 0
@@ -0,0 +1,235 @@
+# pipeline.py
+import cv2
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+# Marks the end of the source; never dropped, always the last item of a queue
+_DONE = object()
+
+class StageMetrics(object):
+    """Counters of one stage: items done and dropped, time spent queued and in fn."""
+
+    def __init__(self):
+        self.processed = 0
+        self.dropped = 0
+        self.wait_total = 0.0
+        self.service_total = 0.0
+        self.service_max = 0.0
+
+    def record(self, wait, service):
+        self.processed += 1
+        self.wait_total += wait
+        self.service_total += service
+        self.service_max = max(self.service_max, service)
+
+    def snapshot(self, depth):
+        n = max(self.processed, 1)
+        return {
+            'depth': depth,
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'wait_ms': self.wait_total / n * 1000,
+            'service_ms': self.service_total / n * 1000,
+            'service_max_ms': self.service_max * 1000,
+        }
+
+class Stage(object):
+    """
+    One step of a Pipeline. fn runs on `workers` threads owned by the stage
+    and returns the item for the next stage, or None to pass nothing on.
+    Items wait in a queue of at most maxsize; when it is full the stage
+    before blocks (backpressure), or with drop_oldest the oldest waiting item
+    is discarded instead. If init is given it is called once per worker and
+    fn is called as fn(state, item), e.g. for per-thread scratch buffers.
+    With several workers items can leave the stage out of order, so stateful
+    steps (like optical flow between consecutive frames) need workers=1.
+    """
+
+    def __init__(self, name, fn, workers=1, maxsize=4, drop_oldest=False, init=None):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.maxsize = maxsize
+        self.drop_oldest = drop_oldest
+        self.init = init
+        self.metrics = StageMetrics()
+        self.queue = None
+
+class Pipeline(object):
+    """
+    Runs a blocking source iterable (e.g. frames of a cv2.VideoCapture) and a
+    chain of Stages concurrently on an asyncio loop. Every stage has its own
+    threads, so while one frame is in Farneback the next is being decoded
+    and the previous one classified; OpenCV and numpy release the GIL for
+    most of that work. sink(item) is called on the loop with each output of
+    the last stage. gauges maps extra metric names to zero-argument callables
+    read at report time (e.g. the motion gate's skip ratio).
+    """
+
+    def __init__(self, source, stages, sink=None, gauges=None):
+        self.source = source
+        self.stages = stages
+        self.sink = sink
+        self.gauges = gauges or {}
+        self.capture = StageMetrics()
+        self.end_to_end_total = 0.0
+        self.end_to_end_max = 0.0
+        self.outputs = 0
+
+    async def _put(self, stage, envelope):
+        if stage.drop_oldest and envelope[2] is not _DONE:
+            while stage.queue.full():
+                stage.queue.get_nowait()
+                stage.metrics.dropped += 1
+            stage.queue.put_nowait(envelope)
+        else:
+            await stage.queue.put(envelope)
+
+    async def _read_source(self, executor):
+        loop = asyncio.get_running_loop()
+        iterator = iter(self.source)
+        first = self.stages[0]
+        while True:
+            start = time.perf_counter()
+            item = await loop.run_in_executor(executor, next, iterator, _DONE)
+            now = time.perf_counter()
+            if item is _DONE:
+                break
+            self.capture.record(0.0, now - start)
+            # (captured at, queued at, item)
+            await self._put(first, (now, now, item))
+        await self._put(first, (None, None, _DONE))
+
+    async def _worker(self, index, executor, remaining):
+        loop = asyncio.get_running_loop()
+        stage = self.stages[index]
+        following = self.stages[index + 1] if index + 1 < len(self.stages) else None
+        state = stage.init() if stage.init is not None else None
+        args = (state,) if stage.init is not None else ()
+
+        while True:
+            captured, queued, item = await stage.queue.get()
+            if item is _DONE:
+                # Let the sibling workers see it too; the last one to stop passes it on
+                stage.queue.put_nowait((None, None, _DONE))
+                remaining[index] -= 1
+                if remaining[index] == 0:
+                    stage.queue.get_nowait()
+                    if following is not None:
+                        await self._put(following, (None, None, _DONE))
+                return
+
+            start = time.perf_counter()
+            result = await loop.run_in_executor(executor, stage.fn, *args, item)
+            now = time.perf_counter()
+            stage.metrics.record(start - queued, now - start)
+            if result is None:
+                continue
+
+            if following is not None:
+                await self._put(following, (captured, now, result))
+            else:
+                self.outputs += 1
+                self.end_to_end_total += now - captured
+                self.end_to_end_max = max(self.end_to_end_max, now - captured)
+                if self.sink is not None:
+                    self.sink(result)
+
+    async def _report(self, every):
+        while True:
+            await asyncio.sleep(every)
+            self.report()
+
+    async def run(self, report_every=None):
+        """Runs until the source is exhausted and every stage has drained."""
+        for stage in self.stages:
+            stage.queue = asyncio.Queue(maxsize=stage.maxsize)
+        executors = [ThreadPoolExecutor(max_workers=1, thread_name_prefix='capture')]
+        executors += [ThreadPoolExecutor(max_workers=stage.workers, thread_name_prefix=stage.name) for stage in self.stages]
+        remaining = [stage.workers for stage in self.stages]
+
+        reporter = asyncio.ensure_future(self._report(report_every)) if report_every else None
+        try:
+            tasks = [self._read_source(executors[0])]
+            for index, stage in enumerate(self.stages):
+                tasks += [self._worker(index, executors[index + 1], remaining) for _ in range(stage.workers)]
+            await asyncio.gather(*tasks)
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+            for executor in executors:
+                executor.shutdown(wait=True)
+
+    def run_sync(self, report_every=None):
+        asyncio.run(self.run(report_every))
+
+    def metrics(self):
+        """Per-stage queue depth, counts and mean/max latencies, plus end-to-end latency of the outputs."""
+        stats = {'capture': self.capture.snapshot(0)}
+        for stage in self.stages:
+            stats[stage.name] = stage.metrics.snapshot(stage.queue.qsize() if stage.queue is not None else 0)
+        stats['end_to_end'] = {
+            'outputs': self.outputs,
+            'mean_ms': self.end_to_end_total / max(self.outputs, 1) * 1000,
+            'max_ms': self.end_to_end_max * 1000,
+        }
+        for name, read in self.gauges.items():
+            stats[name] = read()
+        return stats
+
+    def report(self):
+        stats = self.metrics()
+        print("\n--- PIPELINE METRICS ---")
+        print(f"{'stage':<10}{'depth':>6}{'done':>8}{'dropped':>9}{'wait ms':>9}{'mean ms':>9}{'max ms':>9}")
+        for name, s in stats.items():
+            if not isinstance(s, dict) or name == 'end_to_end':
+                continue
+            print(f"{name:<10}{s['depth']:>6}{s['processed']:>8}{s['dropped']:>9}"
+                  f"{s['wait_ms']:>9.2f}{s['service_ms']:>9.2f}{s['service_max_ms']:>9.2f}")
+        e = stats['end_to_end']
+        print(f"end-to-end: {e['outputs']} outputs, mean {e['mean_ms']:.2f} ms, max {e['max_ms']:.2f} ms")
+        for name in self.gauges:
+            print(f"{name}: {stats[name]:.3f}")
+        print("--- END PIPELINE METRICS ---\n")
+
+def frames_of(cap):
+    """(frame, timestamp in seconds) for every frame a cv2.VideoCapture yields."""
+    while cap.isOpened():
+        ret, frame = cap.read()
+        if not ret:
+            break
+        yield frame, cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+
+def detector_pipeline(detector, source, sink=None, feature_workers=2, maxsize=4, drop_oldest=False):
+    """
+    A Pipeline running StreamDetector's steps as stages: flow (sequential,
+    keeps the previous frame), features (poscal, split and getFeaturesUV on
+    feature_workers threads, each with its own workspace) and classify.
+    The sink gets the same (frame_index, timestamp, verdicts) tuples as
+    StreamDetector.run, possibly out of order when feature_workers > 1.
+    Frames the detector's motion gate skips stop at the flow stage, and the
+    gate's skip ratio is reported as a gauge. drop_oldest only applies after
+    the flow stage: flow must see every frame so that it is always taken
+    between neighbours and frame indices stay true capture indices.
+    """
+
+    def flow(item):
+        return detector.flow_step(*item)
+
+    def features(workspace, item):
+        frame_index, timestamp, gray, flow_field = item
+        positions, frame_features = detector.frame_features(gray, flow_field, workspace)
+        return frame_index, timestamp, positions, frame_features
+
+    def classify(item):
+        frame_index, timestamp, positions, frame_features = item
+        return frame_index, timestamp, detector.classify(positions, frame_features)
+
+    stages = [
+        Stage('flow', flow, workers=1, maxsize=maxsize),
+        Stage('features', features, workers=feature_workers, maxsize=maxsize, drop_oldest=drop_oldest, init=dict),
+        Stage('classify', classify, workers=1, maxsize=maxsize, drop_oldest=drop_oldest),
+    ]
+    gauges = {'skip_ratio': lambda: detector.gate.skip_ratio} if detector.gate is not None else None
+    return Pipeline(source, stages, sink, gauges)
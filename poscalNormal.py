@@ -1,6 +1,7 @@
 # coding:utf8
 import cv2
 import numpy as np
+from scipy import ndimage
 from skimage import measure
 
 font=cv2.FONT_HERSHEY_COMPLEX
@@ -11,23 +12,19 @@ def poscalNormal(img1,img4):
     im = cv2.morphologyEx(img1, cv2.MORPH_OPEN, kernel)    # open operation
     im = cv2.morphologyEx(im, cv2.MORPH_CLOSE, kernel)    # close operation
     im_labels = measure.label(im,connectivity=1)       #tag each connected component from 0
-
-
     num = im_labels.max()     # number of connected components
 
     if num==0:
         im_s = np.zeros((1,5))   # if ab_fg_img is NONE
     else:
+        # One pass over the label image for every component's bounding slices and area
+        slices = ndimage.find_objects(im_labels)
         im_s = np.zeros((num,5))
-        for i in range(num):
-            temp = np.copy(im_labels)
-            temp[temp != (i+1)]=0
-            index = np.where(temp ==(i+1))
-            im_s[i,0]= max(index[0]) #person's foot y_val
-            im_s[i,1]= min(index[0]) #person's head y_val
-            im_s[i,2]= max(index[1]) #person's right side x_val
-            im_s[i,3]= min(index[1]) #person's left side x_val
-            im_s[i,4]= len(index[0]) #area of the person
+        im_s[:,0] = [s[0].stop - 1 for s in slices] #person's foot y_val
+        im_s[:,1] = [s[0].start for s in slices]    #person's head y_val
+        im_s[:,2] = [s[1].stop - 1 for s in slices] #person's right side x_val
+        im_s[:,3] = [s[1].start for s in slices]    #person's left side x_val
+        im_s[:,4] = np.bincount(im_labels.ravel(), minlength=num+1)[1:] #area of the person
     return im_s,im
 
 
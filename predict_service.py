@@ -0,0 +1,267 @@
+# predict_service.py
+import os
+import time
+import queue
+import socket
+import secrets
+import argparse
+import ipaddress
+import threading
+import numpy as np
+from concurrent.futures import Future
+from multiprocessing.connection import Listener, Client
+
+from model_store import load_model
+
+DEFAULT_ADDRESS = ('127.0.0.1', 6001)
+AUTHKEY_ENV = 'PREDICT_SERVICE_AUTHKEY'
+DEFAULT_AUTHKEY_FILE = os.path.join(os.path.expanduser('~'), '.predict_service_key')
+
+def load_authkey(path=None, create=False):
+    """
+    The service's shared secret: $PREDICT_SERVICE_AUTHKEY if set, else the
+    contents of path (default ~/.predict_service_key). With create, a missing
+    key file is made with a random key, readable by its owner only. Messages
+    are unpickled, so anyone holding the key can run code in the service.
+    """
+    key = os.environ.get(AUTHKEY_ENV)
+    if key:
+        return key.encode()
+    path = path or DEFAULT_AUTHKEY_FILE
+    if not os.path.exists(path):
+        if not create:
+            raise FileNotFoundError(f"No predict service key: set {AUTHKEY_ENV} or create {path}")
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+        print(f"[INFO] Created predict service key {path}")
+    if os.name == 'posix' and os.stat(path).st_mode & 0o077:
+        raise PermissionError(f"Predict service key {path} is accessible to other users; chmod 600 it")
+    with open(path) as f:
+        return f.read().strip().encode()
+
+def is_loopback(host):
+    return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+
+class PredictService(object):
+    """
+    Shares one model between many camera streams. Feature batches submitted
+    by the streams are coalesced into micro-batches: a batch is closed when
+    every registered stream has contributed, when it holds max_batch rows, or
+    max_latency seconds after its first request, whichever comes first. Each
+    micro-batch is one vectorised model.predict, and the verdicts are split
+    back into the futures of the requests they came from. While only one
+    stream is registered there is nothing to coalesce, so its requests are
+    predicted directly in the caller's thread.
+
+    Coalescing pays off for models with a high fixed cost per predict call,
+    such as pickled sklearn estimators and the KDTree of an exported KNN.
+    The exported SVM and linear models are plain numpy and predict per
+    frame at least as fast on their own, so for them the service mainly
+    lets many streams share one loaded model.
+    """
+
+    def __init__(self, model, max_latency=0.005, max_batch=8192):
+        self.model = model
+        self.max_latency = max_latency
+        self.max_batch = max_batch
+
+        self.batches = 0
+        self.rows = 0
+        self._streams = set()
+        self._closed = False
+        self._lock = threading.Lock()
+        self._requests = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, name='predict_service', daemon=True)
+        self._thread.start()
+
+    def register(self, stream_id):
+        with self._lock:
+            self._streams.add(stream_id)
+
+    def unregister(self, stream_id):
+        with self._lock:
+            self._streams.discard(stream_id)
+
+    def submit(self, stream_id, features):
+        """
+        Queues a (boxes, features) array from stream_id; returns a Future of
+        its predictions. Raises RuntimeError once the service is closed.
+        """
+        future = Future()
+        features = np.asarray(features)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("PredictService is closed")
+            alone = stream_id is not None and self._streams == {stream_id}
+            if not alone:
+                self._requests.put((stream_id, features, future))
+        if alone:
+            self._run([(stream_id, features, future)], count=False)
+        return future
+
+    def predict(self, features, stream_id=None):
+        return self.submit(stream_id, features).result()
+
+    def stream(self, stream_id):
+        """A model-like handle for one stream, e.g. StreamDetector(service.stream('cam3'), weight)."""
+        self.register(stream_id)
+        return StreamModel(self, stream_id)
+
+    def _loop(self):
+        stopping = False
+        while not stopping:
+            request = self._requests.get()
+            if request is None:
+                break
+            batch = [request]
+            rows = request[1].shape[0]
+            senders = {request[0]}
+            deadline = time.perf_counter() + self.max_latency
+
+            while rows < self.max_batch:
+                with self._lock:
+                    if self._streams and self._streams <= senders:
+                        break
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                batch.append(request)
+                rows += request[1].shape[0]
+                senders.add(request[0])
+
+            self._run(batch)
+
+        # Requests still queued behind the stop marker are failed, never left pending
+        while True:
+            try:
+                request = self._requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None:
+                request[2].set_exception(RuntimeError("PredictService is closed"))
+
+    def _run(self, batch, count=True):
+        """Predicts the rows of a batch in one call; count=False leaves it out of the batch statistics."""
+        sizes = [features.shape[0] for _, features, _ in batch]
+        try:
+            features = [features for _, features, _ in batch if features.shape[0] > 0]
+            predictions = self.model.predict(np.concatenate(features)) if features else np.zeros(0, dtype=int)
+        except Exception as error:
+            for _, _, future in batch:
+                future.set_exception(error)
+            return
+
+        if count:
+            self.batches += 1
+            self.rows += predictions.shape[0]
+        for (_, _, future), part in zip(batch, np.split(predictions, np.cumsum(sizes)[:-1])):
+            future.set_result(part)
+
+    def close(self):
+        """Stops the batching thread; requests still queued fail with RuntimeError."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._requests.put(None)
+        self._thread.join()
+
+class StreamModel(object):
+    """The predict() of one stream, routed through a PredictService."""
+
+    def __init__(self, service, stream_id):
+        self.service = service
+        self.stream_id = stream_id
+
+    def predict(self, features):
+        return self.service.predict(features, self.stream_id)
+
+    def close(self):
+        self.service.unregister(self.stream_id)
+
+def _handle_connection(service, conn):
+    """Serves one client: each message is (stream_id, features), each reply ('ok', predictions) or ('error', message)."""
+    stream_ids = set()
+    try:
+        while True:
+            try:
+                stream_id, features = conn.recv()
+            except EOFError:
+                break
+            if stream_id not in stream_ids:
+                stream_ids.add(stream_id)
+                service.register(stream_id)
+            try:
+                conn.send(('ok', service.predict(features, stream_id)))
+            except Exception as error:
+                conn.send(('error', f"{type(error).__name__}: {error}"))
+    finally:
+        for stream_id in stream_ids:
+            service.unregister(stream_id)
+        conn.close()
+
+def serve(service, authkey, address=DEFAULT_ADDRESS, ready=None, allow_remote=False):
+    """
+    Accepts local socket clients (see PredictClient) until the process is
+    stopped, one thread per connection, all feeding the same service.
+    ready, if given, is a threading.Event set once the socket is listening.
+    Addresses other than loopback are refused unless allow_remote is set.
+    """
+    if not allow_remote and not is_loopback(address[0]):
+        raise ValueError(f"Refusing to serve on non-loopback address {address[0]!r} without allow_remote")
+    with Listener(address, authkey=authkey) as listener:
+        print(f"[INFO] Predict service listening on {listener.address}")
+        if ready is not None:
+            ready.set()
+        while True:
+            conn = listener.accept()
+            threading.Thread(target=_handle_connection, args=(service, conn), daemon=True).start()
+
+class PredictClient(object):
+    """Model-like client of a served PredictService; one connection per stream."""
+
+    def __init__(self, stream_id, address=DEFAULT_ADDRESS, authkey=None):
+        if authkey is None:
+            authkey = load_authkey()
+        self.stream_id = stream_id
+        self._conn = Client(address, authkey=authkey)
+
+    def predict(self, features):
+        self._conn.send((self.stream_id, np.asarray(features)))
+        status, payload = self._conn.recv()
+        if status != 'ok':
+            raise RuntimeError(f"Predict service error: {payload}")
+        return payload
+
+    def close(self):
+        self._conn.close()
+
+def parse_address(text):
+    """'host:port' or ':port' -> (host, port)."""
+    host, _, port = text.rpartition(':')
+    return (host or DEFAULT_ADDRESS[0], int(port))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve one model to many detector streams over a local socket. Micro-batching "
+                                                 "helps sklearn and KNN models; for exported SVM/linear models it mainly saves a model copy per stream.")
+    parser.add_argument("--model", type=str, required=True, help="Exported model directory or a joblib .pkl.")
+    parser.add_argument("--address", type=str, default=f"{DEFAULT_ADDRESS[0]}:{DEFAULT_ADDRESS[1]}")
+    parser.add_argument("--max-latency-ms", type=float, default=5.0, help="Longest a request waits for its micro-batch to fill.")
+    parser.add_argument("--max-batch", type=int, default=8192, help="Rows after which a micro-batch is run immediately.")
+    parser.add_argument("--authkey-file", type=str, default=None,
+                        help=f"Shared secret of the service and its clients, created if missing (default: ${AUTHKEY_ENV} or {DEFAULT_AUTHKEY_FILE}).")
+    parser.add_argument("--allow-remote", action="store_true",
+                        help="Allow a non-loopback --address. Any client with the key can run code in the service.")
+    args = parser.parse_args()
+
+    authkey = load_authkey(args.authkey_file, create=True)
+    service = PredictService(load_model(args.model), max_latency=args.max_latency_ms / 1000.0, max_batch=args.max_batch)
+    serve(service, authkey, parse_address(args.address), allow_remote=args.allow_remote)
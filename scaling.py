@@ -0,0 +1,34 @@
+# scaling.py
+import cv2
+import numpy as np
+
+def scaled_size(height, width, scale):
+    """(height, width) of a frame processed at `scale` of its native resolution."""
+    return max(1, int(round(height * scale))), max(1, int(round(width * scale)))
+
+def resize(img, scale, interpolation=cv2.INTER_AREA):
+    """img at `scale`; returned unchanged at scale 1.0 or if None. Use INTER_NEAREST for masks."""
+    if img is None or scale == 1.0:
+        return img
+    height, width = scaled_size(img.shape[0], img.shape[1], scale)
+    return cv2.resize(np.ascontiguousarray(img), (width, height), interpolation=interpolation)
+
+def scale_weight(weight, scale):
+    """
+    The perspective weight of every row of a frame processed at `scale`:
+    the native per-row weight sampled at the centre of each scaled row.
+    """
+    weight = np.asarray(weight)
+    if scale == 1.0:
+        return weight
+    height = scaled_size(weight.shape[0], 1, scale)[0]
+    native_rows = (np.arange(height) + 0.5) / scale - 0.5
+    return np.interp(native_rows, np.arange(weight.shape[0]), weight)
+
+def to_native(positions, scale):
+    """[max_r, min_r, max_c, min_c, area] boxes found at `scale`, in native pixel coordinates."""
+    if scale == 1.0:
+        return positions
+    native = np.asarray(positions, dtype=np.float64) / scale
+    native[:, 4] /= scale
+    return native
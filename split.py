@@ -4,38 +4,45 @@ import numpy as np
 class Spliter(object):
     """
     A class to intelligently split large connected components (blobs) into
-    smaller, person-sized bounding boxes. This is a high-performance version
-    that avoids slow operations in loops.
+    smaller, person-sized bounding boxes. Blob weights come from one gather,
+    grid-cell sums from one integral image per frame, and only the loop over
+    the blobs themselves stays in Python. At a processing scale below 1.0
+    the pixel constants shrink with the image (areas with its square), and
+    the weight passed to split() must be the scaled one (scaling.scale_weight).
     """
     normal = 120
     heightNorm = 20
     widthNorm = 6
 
-    def __init__(self, discardFloor=0.5, splitCeil=2.0):
-        self.floor = discardFloor * Spliter.normal
-        self.ceil = splitCeil * Spliter.normal
+    def __init__(self, discardFloor=0.5, splitCeil=2.0, scale=1.0):
+        self.scale = scale
+        self.normal = Spliter.normal * scale * scale
+        self.heightNorm = Spliter.heightNorm * scale
+        self.widthNorm = Spliter.widthNorm * scale
+        self.floor = discardFloor * self.normal
+        self.ceil = splitCeil * self.normal
 
     def split(self, pos, fg_img, weight):
         posArea, heights, widths = self.areaHeightWidthCompute(pos, weight)
-        
+        posArea, heights, widths = posArea[:, 0], heights[:, 0], widths[:, 0]
+
+        # Summed-area table of the morphology image, built once and only if a blob needs splitting
+        integral = None
+
         # Use a fast Python list for building results
         realPos_list = []
 
-        for ind, area in enumerate(posArea):
-            height = heights[ind]
-            width = widths[ind]
-
-            if area < self.floor:
-                continue
+        for ind in np.flatnonzero(posArea >= self.floor):
+            area = posArea[ind]
 
             if area > self.ceil:
-                n_h = int(round(height[0] / Spliter.heightNorm))
+                n_h = int(round(heights[ind] / self.heightNorm))
                 if n_h == 0: n_h = 1
 
-                n_w = int(round(width[0] / Spliter.widthNorm))
+                n_w = int(round(widths[ind] / self.widthNorm))
                 if n_w == 0: n_w = 1
                 
-                n = min(int(round(area[0] / Spliter.normal)), n_w * n_h)
+                n = min(int(round(area / self.normal)), n_w * n_h)
                 if n == 0: n = 1
 
                 box_height = pos[ind][0] - pos[ind][1]
@@ -43,53 +50,69 @@ class Spliter(object):
                 if box_height <= 0 or box_width <= 0:
                     continue
 
+                if integral is None:
+                    integral = np.zeros((fg_img.shape[0] + 1, fg_img.shape[1] + 1))
+                    np.cumsum(fg_img, axis=0, dtype=np.float64, out=integral[1:, 1:])
+                    np.cumsum(integral[1:, 1:], axis=1, out=integral[1:, 1:])
+
+                # Every cell of the n_h x n_w grid at once, in row-major order
                 step_y = box_height / n_h
                 step_x = box_width / n_w
+                rows = np.arange(n_h)
+                cols = np.arange(n_w)
+                pos1 = (pos[ind][1] + rows * step_y).astype(np.int64)
+                pos0 = (pos[ind][1] + (rows + 1) * step_y).astype(np.int64)
+                pos3 = (pos[ind][3] + cols * step_x).astype(np.int64)
+                pos2 = (pos[ind][3] + (cols + 1) * step_x).astype(np.int64)
+                pos1, pos3 = [a.ravel() for a in np.meshgrid(pos1, pos3, indexing='ij')]
+                pos0, pos2 = [a.ravel() for a in np.meshgrid(pos0, pos2, indexing='ij')]
 
-                res = []
-                for i in range(n_h):
-                    pos1 = int(pos[ind][1] + i * step_y)
-                    pos0 = int(pos[ind][1] + (i + 1) * step_y)
-                    for j in range(n_w):
-                        pos3 = int(pos[ind][3] + j * step_x)
-                        pos2 = int(pos[ind][3] + (j + 1) * step_x)
-                        
-                        roi = fg_img[pos1:pos0, pos3:pos2]
-                        if roi.size == 0: continue
-                        res.append([pos0, pos1, pos2, pos3, roi.sum(), roi.mean()])
-                
-                if not res: continue
+                # Clip like slicing does, then drop empty cells
+                y0 = np.clip(pos1, 0, fg_img.shape[0])
+                y1 = np.clip(pos0, 0, fg_img.shape[0])
+                x0 = np.clip(pos3, 0, fg_img.shape[1])
+                x1 = np.clip(pos2, 0, fg_img.shape[1])
+                size = np.maximum(y1 - y0, 0) * np.maximum(x1 - x0, 0)
+                valid = np.flatnonzero(size > 0)
+                if valid.size == 0: continue
 
-                res.sort(key=lambda x: x[-1], reverse=True)
-                
-                num_to_keep = min(n, len(res))
-                for i in range(num_to_keep):
-                    # Slice to get the 5 elements: 4 coords + area
-                    new_box = res[i][:-1]
-                    realPos_list.append(new_box)
+                y0, y1, x0, x1 = y0[valid], y1[valid], x0[valid], x1[valid]
+                sums = integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+                means = sums / size[valid]
+
+                # Top-n cells by mean. Ties keep grid order, as the stable list sort did:
+                # argpartition finds the n-th largest mean, and only the cells at or
+                # above it are sorted.
+                num_to_keep = min(n, valid.size)
+                candidates = np.arange(valid.size)
+                if num_to_keep < valid.size:
+                    kth = np.argpartition(-means, num_to_keep - 1)[num_to_keep - 1]
+                    candidates = np.flatnonzero(means >= means[kth])
+                best = candidates[np.argsort(-means[candidates], kind='stable')[:num_to_keep]]
+
+                # 4 coords + area
+                cells = valid[best]
+                realPos_list.extend(np.stack([pos0[cells], pos1[cells], pos2[cells], pos3[cells], sums[best]], axis=1).tolist())
             else:
                 realPos_list.append(pos[ind].tolist())
         
         # Convert to a NumPy array once at the end
         if not realPos_list:
             return np.zeros((0, 5))
-        return np.array(realPos_list)
+        return np.array(realPos_list, dtype=np.float64)
 
     def areaHeightWidthCompute(self, pos, weight):
-        area = np.zeros((pos.shape[0], 1))
-        height = np.zeros((pos.shape[0], 1))
-        width = np.zeros((pos.shape[0], 1))
-        
-        max_weight_index = len(weight) - 1
+        """Perspective-corrected area, height and width of every blob, as (n, 1) columns."""
+        pos = np.asarray(pos, dtype=np.float64).reshape((-1, 5))
+        weight = np.asarray(weight)
 
-        for ind, eachPos in enumerate(pos):
-            y_index = int((eachPos[0] + eachPos[1]) // 2)
-            y_index = max(0, min(y_index, max_weight_index))
-            
-            w = weight[y_index]
-            if w < 0: w = 0 # Ensure weight is not negative
-            area[ind] = eachPos[-1] * w
-            height[ind] = (eachPos[0] - eachPos[1]) * np.sqrt(w)
-            width[ind] = (eachPos[2] - eachPos[3]) * np.sqrt(w)
+        # One gather of the weight at each blob's vertical centre
+        y_index = np.clip(((pos[:, 0] + pos[:, 1]) // 2).astype(np.int64), 0, len(weight) - 1)
+        w = weight[y_index]
+        w = np.where(w < 0, 0, w) # Ensure weight is not negative
+
+        area = (pos[:, -1] * w).reshape((-1, 1))
+        height = ((pos[:, 0] - pos[:, 1]) * np.sqrt(w)).reshape((-1, 1))
+        width = ((pos[:, 2] - pos[:, 3]) * np.sqrt(w)).reshape((-1, 1))
             
-        return np.nan_to_num(area), np.nan_to_num(height), np.nan_to_num(width)
\ No newline at end of file
+        return np.nan_to_num(area), np.nan_to_num(height), np.nan_to_num(width)